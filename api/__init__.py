@@ -35,12 +35,16 @@ login = LoginManager(app)
 # To implement this feature, Flask-Login needs to know what is the view function that handles logins.
 login.login_view = 'login'
 
+from api.database import RoutingSession, configure_engines
+
 # The database is going to be represented in the application by the database instance. 
 # The database migration engine will also have an instance. 
-db = SQLAlchemy(app)
+# The sessions choose between the main and the read database for every query.
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+configure_engines(app, db)
 migrate = Migrate(app, db)
 
 # To use Mail you need to create an instance - object of class Mail
 mail = Mail(app)
 
-from api import routes, models, users, tokens
\ No newline at end of file
+from api import routes, models, users, posts, tokens, notifications, export, conditional, instrumentation, profiling, metrics, cli
\ No newline at end of file
@@ -0,0 +1,72 @@
+# In-process caches.
+# The TTLCache class is a small thread safe cache with a bounded size, when it is full the least recently used entry is evicted. 
+# Every entry also has a time to live, after which it is dropped even if it is still being used. 
+# The cache counts its hits and misses, so that its size can be tuned by looking at the hit ratio.
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from api import app
+
+
+class TTLCache(object):
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # The OrderedDict keeps the entries in the order they were used, the least recently used entry is the first one
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # The get() method returns the value stored for the key, or the default if the key is missing or has expired
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # The set() method stores a value, the ttl argument can shorten (but not extend) the time to live of the cache for this entry
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # The stats() method returns the counters of the cache, the hit ratio is None until the cache has been used
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None
+            }
+
+
+# The token cache maps bearer tokens to the few user fields that token authentication needs, 
+# so that authenticated API requests don't have to look up the token in the database every time.
+token_cache = TTLCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
@@ -0,0 +1,112 @@
+# Custom commands for the flask command line interface.
+# They are registered on the application with the @app.cli.command decorator, so they run as flask <command>.
+
+import json
+from time import perf_counter
+import click
+from api import app, db
+from api.models import User, Post
+from api.importer import read_rows, import_posts
+from api.export import EXPORTS, export_lines
+from api.profiling import SORT_KEYS, profile_report
+
+
+# The denormalized counters of the users can drift if rows are changed behind the application's back, 
+# this command recomputes all of them in bulk.
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute the post, follower and followed counters of all users."""
+    repaired = User.reconcile_counters()
+    db.session.commit()
+    click.echo('Repaired the counters of {} users'.format(repaired))
+
+
+# The full-text index of the posts is kept in sync by triggers, 
+# this command rebuilds it from scratch for posts that were written before the index existed.
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Rebuild the full-text search index of the posts."""
+    Post.rebuild_search_index()
+    db.session.commit()
+    click.echo('Rebuilt the search index of {} posts'.format(Post.query.count()))
+
+
+# The administrators can export the data of all the users. The flag can't be set through the API, only with this command.
+@app.cli.command('set-admin')
+@click.argument('username')
+@click.option('--revoke', is_flag=True, help='Remove the administrator flag instead.')
+def set_admin(username, revoke):
+    """Make a user an administrator, or revoke it."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter('there is no user {}'.format(username), param_hint='USERNAME')
+    user.is_admin = not revoke
+    db.session.commit()
+    click.echo('{} is {}an administrator'.format(username, 'no longer ' if revoke else ''))
+
+
+# Bulk import of the book listings of a seller from a CSV file (with a header line) or a JSON Lines file.
+# Every row has the post_title, description and price fields. The rows are streamed from the file and inserted in chunks, 
+# the rejected rows are reported with their line number and can be written to a JSON Lines file to be fixed and imported again.
+@app.cli.command('import-posts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Username of the seller of the books.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Format of the file, by default taken from its extension.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows inserted per transaction.')
+@click.option('--rejects', type=click.File('w'), help='Write the rejected rows to this file.')
+def import_posts_command(path, username, fmt, chunk_size, rejects):
+    """Import book listings from a CSV or JSON Lines file."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter('there is no user {}'.format(username), param_hint='--user')
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    shown = []
+
+    def reject(line_num, reason, row):
+        if len(shown) < 10:
+            shown.append('line {}: {}'.format(line_num, reason))
+        if rejects is not None:
+            rejects.write(json.dumps({'line': line_num, 'reason': reason, 'row': row}) + '\n')
+
+    start = perf_counter()
+    with open(path, newline='', encoding='utf-8') as f:
+        imported, rejected = import_posts(read_rows(f, fmt), user, chunk_size, reject)
+    elapsed = perf_counter() - start
+    for line in shown:
+        click.echo(line, err=True)
+    click.echo('Imported {} posts and rejected {} rows in {:.2f} seconds ({:.0f} rows/sec)'.format(
+        imported, rejected, elapsed, (imported + rejected) / elapsed if elapsed else 0))
+
+
+# Export of the posts, users or messages for analytics, in NDJSON format.
+@app.cli.command('export')
+@click.argument('name', type=click.Choice(sorted(EXPORTS)))
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Output file, standard output by default.')
+@click.option('--batch-size', type=int, help='Rows fetched from the database at a time.')
+def export_command(name, output, batch_size):
+    """Export posts, users or messages as NDJSON."""
+    for line in export_lines(name, batch_size):
+        output.write(line)
+
+
+# Report of the profiles saved by the sampling profiler (see PROFILE_SAMPLE_RATE)
+@app.cli.command('profile-report')
+@click.option('--top', default=20, show_default=True, help='Number of functions shown per endpoint.')
+@click.option('--sort', type=click.Choice(sorted(SORT_KEYS)), default='cumtime', show_default=True,
+              help='Column the functions are sorted by.')
+@click.option('--endpoint', help='Only show this endpoint.')
+def profile_report_command(top, sort, endpoint):
+    """Show the hottest functions of every endpoint in the saved profiles."""
+    report = profile_report(top, sort)
+    if endpoint is not None:
+        report = {name: value for name, value in report.items() if name == endpoint}
+    if not report:
+        click.echo('No profiles in {}'.format(app.config['PROFILE_DIR']))
+    for name, (count, functions) in report.items():
+        click.echo('{} ({} profiles)'.format(name, count))
+        click.echo('  {:>10} {:>10} {:>10}  function'.format('calls', 'tottime', 'cumtime'))
+        for function, calls, tottime, cumtime in functions:
+            click.echo('  {:>10} {:>10.4f} {:>10.4f}  {}'.format(calls, tottime, cumtime, function))
+        click.echo()
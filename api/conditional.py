@@ -0,0 +1,47 @@
+# Conditional GET support (ETag and Last-Modified).
+# The views compute a validator from the data they are about to return, which is much cheaper than building the response. 
+# When the client already has that version (If-None-Match, or If-Modified-Since when there is no If-None-Match) 
+# the request is answered with a 304 Not Modified response right away, without serializing anything. 
+# Otherwise the validators are added to the response, so that the client can send them back on the next request.
+
+import json
+from hashlib import md5
+from datetime import timezone
+from flask import request, g, abort, Response
+from api import app
+
+
+# The etag_for() function returns the entity tag of a list of values, the values must be JSON serializable or convertible to strings
+def etag_for(*parts):
+    return md5(json.dumps(parts, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates have a resolution of one second
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+# The check_not_modified() function aborts the request with a 304 response if the client has the current version. 
+# last_modified is a naive UTC datetime, like the timestamps of the models.
+def check_not_modified(etag, last_modified=None):
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    g.validators = (etag, last_modified)
+    if is_not_modified(etag, last_modified):
+        abort(Response(status=304))
+
+
+# The validators are added to the responses of the views that called check_not_modified()
+@app.after_request
+def add_validators(response):
+    validators = g.pop('validators', None)
+    if validators is not None and response.status_code in (200, 304):
+        etag, last_modified = validators
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+    return response
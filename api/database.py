@@ -0,0 +1,68 @@
+# Database engine setup.
+# The SQLite connections are tuned with pragmas when they are opened: the write-ahead log lets the readers work while 
+# a writer commits, synchronous=NORMAL only syncs the log at checkpoints, and the memory map and the page cache 
+# keep the hot pages of the database in memory. The values come from the SQLITE_* configuration settings.
+# When a 'read' bind is configured (DATABASE_READ_URL, for example a read-only connection to the same file or a replica), 
+# the GET requests of the views marked with the read_only decorator run their queries on it, so long reads never wait for the writers. 
+# Writes (the flushes of the session) always go to the main database.
+
+import sqlite3
+from flask import current_app, request, has_request_context
+import sqlalchemy as sa
+from flask_sqlalchemy.session import Session
+
+
+# The read_only decorator marks a view that doesn't write to the database. 
+# The decorators of Flask-HTTPAuth and Flask-Login copy the mark, so it can be used anywhere below the route decorator.
+def read_only(f):
+    f.read_only = True
+    return f
+
+
+def is_read_only_request():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    return getattr(current_app.view_functions.get(request.endpoint), 'read_only', False)
+
+
+# The RoutingSession class is the session class of db.session. Inside the read-only requests, 
+# everything but the flushes uses the 'read' engine if there is one.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and is_read_only_request():
+            engine = self._db.engines.get('read')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# The add_sqlite_pragmas() function sets the pragmas on every new connection of an engine
+def add_sqlite_pragmas(app, engine):
+    pragmas = [
+        ('journal_mode', app.config['SQLITE_JOURNAL_MODE']),
+        ('synchronous', app.config['SQLITE_SYNCHRONOUS']),
+        ('mmap_size', app.config['SQLITE_MMAP_SIZE']),
+        ('cache_size', app.config['SQLITE_CACHE_SIZE'])
+    ]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                try:
+                    cursor.execute('PRAGMA {} = {}'.format(name, value))
+                except sqlite3.OperationalError:
+                    # A read-only connection can't change the journal mode, it uses the one of the database file
+                    app.logger.debug('Could not set PRAGMA %s', name)
+        finally:
+            cursor.close()
+
+    sa.event.listen(engine, 'connect', set_pragmas)
+
+
+# The configure_engines() function adds the pragmas to all the SQLite engines of the application
+def configure_engines(app, db):
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                add_sqlite_pragmas(app, engine)
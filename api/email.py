@@ -2,29 +2,96 @@ from flask_mail import Message
 from flask import render_template
 from api import mail, app
 # support for running asynchronous tasks by threading
-from threading import Thread
+from threading import Thread, Lock
+from queue import Queue, Empty, Full
 
 
-# The send_async_email function now runs in a background thread, invoked via the Thread class,
-# so that the application can continue running concurrently with the email being sent.
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# The emails are delivered by a small pool of background worker threads, so that the application can continue running concurrently 
+# with the emails being sent. The messages wait in a bounded queue, and every worker takes all the messages that are waiting 
+# (up to MAIL_BATCH_SIZE) and sends them through a single SMTP connection, instead of connecting to the server for every email.
+# When the queue is full, send_email() waits up to MAIL_QUEUE_TIMEOUT seconds for a free slot and then drops the email, 
+# so a burst of emails slows down the requests that send them instead of piling up threads and messages in memory.
+class MailQueue(object):
+    def __init__(self, app, workers, maxsize, batch_size, timeout):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queue = Queue(maxsize)
+        self.threads = []
+        self.lock = Lock()
 
-# Email sending wrapper function.
+    # The worker threads are started the first time an email is queued
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, msg):
+        self.start()
+        self.queue.put(msg, timeout=self.timeout)
+
+    # Number of emails waiting to be sent
+    def qsize(self):
+        return self.queue.qsize()
+
+    # The join() method blocks until all the queued emails have been handled
+    def join(self):
+        self.queue.join()
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.send_batch(batch)
+            finally:
+                for msg in batch:
+                    self.queue.task_done()
+
+    # A failed email is logged and doesn't stop the rest of the batch, a failed connection loses the whole batch
+    def send_batch(self, batch):
+        with self.app.app_context():
+            try:
+                with mail.connect() as connection:
+                    for msg in batch:
+                        try:
+                            connection.send(msg)
+                        except Exception:
+                            self.app.logger.exception('Could not send email to %s', msg.recipients)
+            except Exception:
+                self.app.logger.exception('Could not deliver %d emails', len(batch))
+
+
+mail_queue = MailQueue(app, app.config['MAIL_WORKERS'], app.config['MAIL_QUEUE_SIZE'],
+                       app.config['MAIL_BATCH_SIZE'], app.config['MAIL_QUEUE_TIMEOUT'])
+
+# Email sending wrapper function. It returns False when the email was dropped because the queue stayed full, 
+# the views carry on as usual, a dropped email is like one lost by the mail server.
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    try:
+        mail_queue.put(msg)
+    except Full:
+        app.logger.warning('The mail queue is full, dropped the email to %s', recipients)
+        return False
+    return True
 
 # Send password reset email function.
 def send_password_reset_email(user):
     token = user.get_reset_password_token()
-    send_email('[Bookstore] Reset Your Password',
+    return send_email('[Bookstore] Reset Your Password',
                sender=app.config['ADMINS'][0],
                recipients=[user.email],
                text_body=render_template('reset_password.txt',
                                          user=user, token=token),
                html_body=render_template('reset_password.html',
-                                         user=user, token=token))
\ No newline at end of file
+                                         user=user, token=token))
@@ -0,0 +1,53 @@
+# Streaming export of the data for analytics, in NDJSON format (one JSON document per line).
+# The rows are read with a server-side cursor in batches of EXPORT_BATCH_SIZE, straight from the tables without going through 
+# the ORM, and written out as they are read, so exporting a table takes the same memory no matter how many rows it has.
+
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import Response, stream_with_context, abort
+from api import app, db
+from api.auth import token_auth
+from api.models import User, Post, Message
+from api.database import read_only
+
+# The columns exported for each resource. The password hashes, tokens and emails of the users are never exported.
+user = User.__table__
+EXPORTS = {
+    'posts': list(Post.__table__.columns),
+    'users': [user.c.id, user.c.username, user.c.about_me, user.c.last_seen,
+              user.c.post_count, user.c.follower_count, user.c.followed_count],
+    'messages': list(Message.__table__.columns)
+}
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+# The export_lines() generator yields one NDJSON line for every row of the resource, in id order
+def export_lines(name, batch_size=None):
+    columns = EXPORTS[name]
+    batch_size = batch_size or app.config['EXPORT_BATCH_SIZE']
+    query = sa.select(*columns).order_by(columns[0].table.c.id)
+    # The engine is chosen by the session, so the export endpoint reads from the read database when there is one
+    with db.session.get_bind(clause=query).connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(query)
+        for row in result:
+            yield json.dumps(row._asdict(), default=json_default) + '\n'
+
+
+# Export endpoint, the response is generated while the rows are read from the database. 
+# Exports include the private messages of all the users, so they are restricted to the administrators (see User.is_admin).
+@app.route('/export/<name>', methods=['GET'])
+@read_only
+@token_auth.login_required
+def export(name):
+    if not token_auth.current_user().is_admin:
+        abort(403)
+    if name not in EXPORTS:
+        abort(404)
+    return Response(stream_with_context(export_lines(name)), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename={}.ndjson'.format(name)})
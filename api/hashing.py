@@ -0,0 +1,78 @@
+# Password hashing service.
+# The password hashes are deliberately slow to compute, and computing them in the request thread holds the GIL 
+# and stalls the other requests served by the same process. The hashes are computed by a pool of PASSWORD_HASH_WORKERS 
+# processes instead, and the request thread just waits for the result (with PASSWORD_HASH_WORKERS set to 0 they are computed inline). 
+# The cost of the hash is given by PASSWORD_HASH_METHOD, in the format of werkzeug (for example pbkdf2:sha256:600000). 
+# The hashes made with another method are still accepted, and are replaced when the user logs in with the correct password.
+
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from api import app
+
+
+class PasswordHasher(object):
+    def __init__(self, method, workers):
+        self.method = method
+        self.workers = workers
+        self.executor = None
+        self.lock = Lock()
+
+    # The worker processes are started the first time a password is hashed, after the application is fully loaded. 
+    # By then the process already runs the mail and server threads, and forking a multi-threaded process can copy locks 
+    # held by other threads, so the workers are spawned instead.
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    # A worker that dies (killed by the OOM killer, for example) breaks the whole pool, 
+    # so the broken pool is dropped and the call is retried once on a new one
+    def run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        executor = self.get_executor()
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            app.logger.warning('The password hashing pool is broken, starting a new one')
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            executor.shutdown(wait=False)
+            return self.get_executor().submit(function, *args).result()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    # The hash_prefix() method returns the part of the hashes before the salt for the configured method. 
+    # A method can leave out its parameters (pbkdf2:sha256 or scrypt), werkzeug then writes its defaults in the hash 
+    # (pbkdf2:sha256:600000), so they are filled in the same way here.
+    def hash_prefix(self):
+        method, *args = self.method.split(':')
+        if method == 'scrypt' and not args:
+            return 'scrypt:{}:{}:{}'.format(2 ** 15, 8, 1)
+        if method == 'pbkdf2' and len(args) < 2:
+            return 'pbkdf2:{}:{}'.format(args[0] if args else 'sha256', DEFAULT_PBKDF2_ITERATIONS)
+        return self.method
+
+    # The needs_rehash() method tells if a hash was made with other parameters than the configured ones
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.hash_prefix()
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'])
+atexit.register(password_hasher.shutdown)
@@ -0,0 +1,95 @@
+# Bulk import of book listings.
+# The rows are streamed from a CSV or a JSON Lines file, validated one by one and inserted in chunks,
+# with one executemany INSERT and one transaction per chunk, so the memory used doesn't depend on the size of the file.
+# The bulk inserts don't go through the ORM, so the post counter of the seller and the timelines of the followers
+# are updated in bulk for every chunk. The full-text index is kept in sync by its triggers.
+
+import csv
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from api import db
+from api.models import User, Post, TimelineEntry
+
+
+# The read_rows() function yields the line number and the fields of every row of the file, the fields are a dictionary
+# (the first line of a CSV file has the column names). Lines that can't be parsed are yielded with None as fields.
+def read_rows(f, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_num, row if isinstance(row, dict) else None
+
+
+# The validate_row() function returns the columns of the post for a row of the file,
+# or raises ValueError with the reason why the row is rejected.
+def validate_row(row):
+    if row is None:
+        raise ValueError('the row could not be parsed')
+    title = (row.get('post_title') or '').strip()
+    description = (row.get('description') or '').strip()
+    if not title:
+        raise ValueError('post_title is missing')
+    if len(title) > Post.post_title.type.length:
+        raise ValueError('post_title is too long')
+    if len(description) > Post.description.type.length:
+        raise ValueError('description is too long')
+    # JSON Lines rows can have a boolean or a float price, that int() would accept
+    price = row.get('price')
+    if isinstance(price, bool) or (isinstance(price, float) and not price.is_integer()):
+        raise ValueError('price is not a whole number')
+    try:
+        price = int(price)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('price is not a whole number')
+    if price < 0:
+        raise ValueError('price is negative')
+    return {'post_title': title, 'description': description or None, 'price': price}
+
+
+# The insert_chunk() function writes a chunk of valid posts of a user in one transaction
+def insert_chunk(user_id, chunk):
+    post = Post.__table__
+    last_id = db.session.scalar(sa.select(sa.func.max(post.c.id))) or 0
+    db.session.execute(sa.insert(post), chunk)
+    User.adjust_counter(user_id, 'post_count', len(chunk))
+    TimelineEntry.fan_out(db.session.connection(),
+                          sa.and_(post.c.user_id == user_id, post.c.id > last_id))
+    # The response cache of the listings is cleared when the chunk is committed
+    db.session.info['posts_changed'] = True
+    db.session.commit()
+
+
+# The import_posts() function imports all the rows for the given user. The rejected rows are passed to the reject callback
+# with the line number, the reason and the fields of the row. It returns the number of imported and rejected rows.
+def import_posts(rows, user, chunk_size=1000, reject=None):
+    imported = rejected = 0
+    chunk = []
+    for line_num, row in rows:
+        try:
+            values = validate_row(row)
+        except ValueError as e:
+            rejected += 1
+            if reject is not None:
+                reject(line_num, str(e), row)
+            continue
+        values['user_id'] = user.id
+        values['timestamp'] = datetime.utcnow()
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            insert_chunk(user.id, chunk)
+            imported += len(chunk)
+            chunk = []
+    if chunk:
+        insert_chunk(user.id, chunk)
+        imported += len(chunk)
+    return imported, rejected
@@ -0,0 +1,105 @@
+# Per-request SQL instrumentation.
+# When SQL_INSTRUMENTATION is set, every statement executed by the engines of the application is counted and timed, 
+# and the totals of the request are sent back in a Server-Timing header (db;dur=<milliseconds>;desc="<n> queries"). 
+# A request that runs the same statement (the SQL text, before the parameters are bound) more than SQL_N_PLUS_ONE_THRESHOLD 
+# times is logged as a warning, which is the usual sign of a relationship loaded once for every item of a collection. 
+# When the instrumentation is disabled the event listeners are not attached at all.
+
+from collections import Counter
+from time import perf_counter
+import sqlalchemy as sa
+from flask import g, request, has_app_context
+from api import app, db
+
+
+# The QueryStats class holds the statements of one request
+class QueryStats(object):
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] += 1
+
+
+class SQLInstrumentation(object):
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.engines = []
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def enable(self, engines):
+        for engine in engines:
+            if engine not in self.engines:
+                sa.event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+                sa.event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+                sa.event.listen(engine, 'handle_error', self.handle_error)
+                self.engines.append(engine)
+
+    def disable(self):
+        for engine in self.engines:
+            sa.event.remove(engine, 'before_cursor_execute', self.before_cursor_execute)
+            sa.event.remove(engine, 'after_cursor_execute', self.after_cursor_execute)
+            sa.event.remove(engine, 'handle_error', self.handle_error)
+        self.engines = []
+
+    # The start times are kept in a stack in the connection, as the SQLAlchemy documentation recommends
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(perf_counter())
+
+    # Statements executed outside of a request (or after its response, by a streamed body) are not recorded
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info['query_start_time'].pop()
+        stats = g.get('query_stats') if has_app_context() else None
+        if stats is not None:
+            stats.record(statement, elapsed)
+
+    # A statement that raises never reaches after_cursor_execute, so its start time is dropped here, 
+    # otherwise the next statement of the connection would be timed from it
+    def handle_error(self, context):
+        if context.connection is not None and context.execution_context is not None:
+            start_times = context.connection.info.get('query_start_time')
+            if start_times:
+                start_times.pop()
+
+    # The most repeated statement of the request, if it was executed more times than the threshold
+    def repeated_statement(self, stats):
+        if not stats.statements:
+            return None
+        statement, count = stats.statements.most_common(1)[0]
+        return (statement, count) if count > self.threshold else None
+
+
+sql_instrumentation = SQLInstrumentation(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+if app.config['SQL_INSTRUMENTATION']:
+    with app.app_context():
+        sql_instrumentation.enable(db.engines.values())
+
+
+# The stats are started before the other before_request functions (the user loaded from the token, last_seen), 
+# which are registered earlier by the routes, so that their queries are counted too
+def start_query_stats():
+    if sql_instrumentation.enabled:
+        g.query_stats = QueryStats()
+
+
+app.before_request_funcs.setdefault(None, []).insert(0, start_query_stats)
+
+
+@app.after_request
+def add_server_timing(response):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    response.headers.add('Server-Timing', 'db;dur={:.3f};desc="{} queries"'.format(stats.time * 1000, stats.count))
+    repeated = sql_instrumentation.repeated_statement(stats)
+    if repeated is not None:
+        app.logger.warning('Possible N+1 queries in %s %s: statement executed %d times: %s',
+                           request.method, request.path, repeated[1], repeated[0])
+    return response
@@ -0,0 +1,63 @@
+# Write-behind buffer for the last_seen field of the users.
+# Recording the last visit time on every request would turn every page view into a write transaction, 
+# so the visits are collected in memory, one entry per user, and written in a single executemany UPDATE 
+# every LAST_SEEN_FLUSH_INTERVAL seconds and when the application shuts down.
+
+import atexit
+from threading import Lock
+from time import monotonic
+from datetime import timedelta
+import sqlalchemy as sa
+from sqlalchemy import orm as so
+from api import app, db
+from api.models import User
+
+
+class LastSeenBuffer(object):
+    def __init__(self, interval, tolerance):
+        # interval is the number of seconds between two flushes, tolerance is how many seconds 
+        # the stored last_seen time can lag behind before a new visit is recorded at all
+        self.interval = interval
+        self.tolerance = timedelta(seconds=tolerance)
+        self.pending = {}
+        self.last_flush = monotonic()
+        self.lock = Lock()
+
+    # The touch() method records a visit of the user. The user object gets the new time right away, without marking it as modified, 
+    # so the current request sees the new value but doesn't write it. 
+    # Whether a flush is due is checked on every request, also when the visit itself isn't recorded, 
+    # so the pending visits of users that went idle are still written after at most one interval.
+    def touch(self, user, now):
+        with self.lock:
+            if user.last_seen is None or now - user.last_seen >= self.tolerance:
+                self.pending[user.id] = now
+                so.attributes.set_committed_value(user, 'last_seen', now)
+            due = bool(self.pending) and monotonic() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    # The flush() method writes all the pending visits in one transaction and returns the number of updated users.
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = monotonic()
+        if not pending:
+            return 0
+        user = User.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                sa.update(user).where(user.c.id == sa.bindparam('user_id')).values(
+                    last_seen=sa.bindparam('seen')),
+                [{'user_id': id, 'seen': seen} for id, seen in pending.items()])
+        return len(pending)
+
+
+last_seen_buffer = LastSeenBuffer(app.config['LAST_SEEN_FLUSH_INTERVAL'],
+                                  app.config['LAST_SEEN_TOLERANCE'])
+
+
+# The visits that are still in the buffer are written when the process exits
+@atexit.register
+def flush_last_seen():
+    with app.app_context():
+        last_seen_buffer.flush()
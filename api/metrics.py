@@ -0,0 +1,382 @@
+# Runtime metrics in the Prometheus text format.
+# The metrics live in an in-process registry. Every metric has its own lock, which is only held to update a dictionary entry,
+# so the request threads barely wait for each other. The /metrics endpoint returns the request counts and latency histograms
+# of every endpoint, the time of the SQL statements, the depth of the mail queue and the hits and misses of the caches.
+# With several server processes (gunicorn workers) every process only sees its own requests, so when METRICS_MULTIPROCESS_DIR
+# is set every process writes a snapshot of its metrics to <pid>.json in that directory (at most every METRICS_SNAPSHOT_INTERVAL
+# seconds), and the endpoint adds up the snapshots of all the processes. The directory should be emptied when the server starts.
+# The snapshot of a process that is gone (a worker recycled by gunicorn) is archived, like mark_process_dead() of prometheus_client does: 
+# its counters and histograms are added to archive.json, so the totals never go backwards, and its gauges are dropped.
+
+import os
+import json
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, monotonic
+import sqlalchemy as sa
+from flask import g, request, Response
+from api import app, db
+from api.cache import token_cache
+from api.email import mail_queue
+from api.response_cache import listing_cache
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    # The collect() method returns the metric as a JSON serializable dictionary, with the samples as [name, labels, value] lists
+    def collect(self):
+        return {'name': self.name, 'type': self.type, 'help': self.help, 'samples': list(self.samples())}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            yield [self.name, dict(zip(self.labels, label_values)), value]
+
+
+# The buckets of a histogram are kept as separate counts and made cumulative when the samples are collected
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in items:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield [self.name + '_bucket', dict(labels, le=format_value(bound)), cumulative]
+            yield [self.name + '_sum', labels, total]
+            yield [self.name + '_count', labels, cumulative]
+
+
+# The values of a callback metric are read when the metrics are collected,
+# the function returns a dictionary with the tuple of label values as keys
+class CallbackMetric(Metric):
+    def __init__(self, name, help, labels, function, type='gauge'):
+        super().__init__(name, help, labels)
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        for label_values, value in self.function().items():
+            yield [self.name, dict(zip(self.labels, label_values)), value]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        return [metric.collect() for metric in self.metrics]
+
+
+# The merge() function adds up the samples of several snapshots (one per process) with the same name and labels
+def merge(snapshots):
+    families = {}
+    for snapshot in snapshots:
+        for family in snapshot:
+            merged = families.setdefault(family['name'], {
+                'type': family['type'], 'help': family['help'], 'samples': {}})
+            for name, labels, value in family['samples']:
+                key = (name, tuple(sorted(labels.items())))
+                merged['samples'][key] = merged['samples'].get(key, 0) + value
+    return families
+
+
+# The snapshot() function converts merged families back to the snapshot format
+def snapshot(families):
+    return [{'name': name, 'type': family['type'], 'help': family['help'],
+             'samples': [[sample, dict(labels), value] for (sample, labels), value in family['samples'].items()]}
+            for name, family in families.items()]
+
+
+def render(families):
+    lines = []
+    for name, family in families.items():
+        lines.append('# HELP {} {}'.format(name, family['help']))
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+        for (sample, labels), value in family['samples'].items():
+            if labels:
+                sample += '{' + ','.join('{}="{}"'.format(label, escape_label(label_value))
+                                         for label, label_value in labels) + '}'
+            lines.append('{} {}'.format(sample, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def cache_counts(index):
+    counts = {('token', ''): (token_cache.hits, token_cache.misses)}
+    for endpoint, stats in listing_cache.stats().items():
+        counts[('response', endpoint)] = (stats['hits'], stats['misses'])
+    return {labels: values[index] for labels, values in counts.items()}
+
+
+registry = Registry()
+http_requests = registry.register(Counter(
+    'http_requests_total', 'Requests handled, by endpoint, method and status code.', ('endpoint', 'method', 'status')))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling the requests, by endpoint.', ('endpoint',)))
+db_query_duration = registry.register(Histogram(
+    'db_query_duration_seconds', 'Execution time of the SQL statements.'))
+registry.register(CallbackMetric(
+    'mail_queue_depth', 'Emails waiting to be sent.', (), lambda: {(): mail_queue.qsize()}))
+registry.register(CallbackMetric(
+    'cache_hits_total', 'Cache lookups that found an entry.', ('cache', 'route'), lambda: cache_counts(0), 'counter'))
+registry.register(CallbackMetric(
+    'cache_misses_total', 'Cache lookups that found no entry.', ('cache', 'route'), lambda: cache_counts(1), 'counter'))
+
+
+# The hit ratios are computed from the added up hits and misses, a ratio can't be added up across processes
+def add_hit_ratios(families):
+    if 'cache_hits_total' not in families:
+        return
+    hits = families['cache_hits_total']['samples']
+    misses = families['cache_misses_total']['samples']
+    samples = {}
+    for (name, labels), value in hits.items():
+        total = value + misses.get(('cache_misses_total', labels), 0)
+        if total:
+            samples[('cache_hit_ratio', labels)] = value / total
+    families['cache_hit_ratio'] = {'type': 'gauge', 'help': 'Fraction of the cache lookups that found an entry.',
+                                   'samples': samples}
+
+
+# The lock of the archive and the liveness check of the processes differ between POSIX and Windows 
+# (where os.kill() terminates the process instead of checking it)
+if os.name == 'nt':
+    import ctypes
+    import msvcrt
+
+    @contextmanager
+    def file_lock(path):
+        with open(path, 'a+') as f:
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK raises an OSError after trying for about 10 seconds
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def process_alive(pid):
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            # ERROR_ACCESS_DENIED, the process exists but belongs to another user
+            return kernel32.GetLastError() == 5
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            # STILL_ACTIVE
+            return exit_code.value == 259
+        finally:
+            kernel32.CloseHandle(handle)
+else:
+    import fcntl
+
+    @contextmanager
+    def file_lock(path):
+        with open(path, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+# Snapshots of the processes in multiprocess mode. The file is replaced atomically, so a scrape never reads half a snapshot.
+class SnapshotWriter(object):
+    def __init__(self, registry):
+        self.registry = registry
+        self.last_write = None
+        self.lock = Lock()
+
+    # A snapshot that already exists before the first write of the process was left by a dead process with the same pid
+    def write(self, directory):
+        path = os.path.join(directory, '{}.json'.format(os.getpid()))
+        with self.lock:
+            if self.last_write is None and os.path.exists(path):
+                self.archive(directory, path)
+            write_json(path, self.registry.collect())
+            self.last_write = monotonic()
+
+    # The archive() method moves the counters and histograms of a snapshot to archive.json and removes the snapshot. 
+    # The processes share the archive, so it is updated under a file lock.
+    @staticmethod
+    def archive(directory, path):
+        with file_lock(os.path.join(directory, 'archive.lock')):
+            try:
+                with open(path) as f:
+                    families = [family for family in json.load(f) if family['type'] != 'gauge']
+            except FileNotFoundError:
+                # Archived by another process in the meantime
+                return
+            except ValueError:
+                app.logger.warning('Could not read the metrics snapshot %s', path)
+                families = []
+            archive_path = os.path.join(directory, 'archive.json')
+            snapshots = [families]
+            if os.path.exists(archive_path):
+                with open(archive_path) as f:
+                    snapshots.append(json.load(f))
+            write_json(archive_path, snapshot(merge(snapshots)))
+            os.remove(path)
+
+    # The archive_dead() method archives the snapshots of the processes that are no longer running
+    @staticmethod
+    def archive_dead(directory):
+        for name in os.listdir(directory):
+            pid, _, extension = name.partition('.')
+            if extension == 'json' and pid.isdigit() and not process_alive(int(pid)):
+                SnapshotWriter.archive(directory, os.path.join(directory, name))
+
+    def write_if_due(self, directory, interval):
+        if self.last_write is None or monotonic() - self.last_write >= interval:
+            self.write(directory)
+
+    @staticmethod
+    def read_all(directory):
+        snapshots = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                app.logger.warning('Could not read the metrics snapshot %s', name)
+        return snapshots
+
+
+snapshot_writer = SnapshotWriter(registry)
+
+
+# The snapshot of the process is archived when it exits, its gauges are no longer true
+def write_final_snapshot():
+    directory = app.config['METRICS_MULTIPROCESS_DIR']
+    if directory:
+        snapshot_writer.write(directory)
+        snapshot_writer.archive(directory, os.path.join(directory, '{}.json'.format(os.getpid())))
+
+
+atexit.register(write_final_snapshot)
+
+
+# The SQL statements are timed with the cursor events of all the engines, the start times are kept in a stack in the connection
+def query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start_time', []).append(perf_counter())
+
+
+def query_finished(conn, cursor, statement, parameters, context, executemany):
+    db_query_duration.observe(perf_counter() - conn.info['metrics_start_time'].pop())
+
+
+def instrument_engine(engine):
+    if not sa.event.contains(engine, 'before_cursor_execute', query_started):
+        sa.event.listen(engine, 'before_cursor_execute', query_started)
+        sa.event.listen(engine, 'after_cursor_execute', query_finished)
+
+
+with app.app_context():
+    for engine in db.engines.values():
+        instrument_engine(engine)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start_time', None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    http_request_duration.observe(perf_counter() - start, endpoint)
+    http_requests.inc(endpoint, request.method, str(response.status_code))
+    directory = app.config['METRICS_MULTIPROCESS_DIR']
+    if directory:
+        snapshot_writer.write_if_due(directory, app.config['METRICS_SNAPSHOT_INTERVAL'])
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    directory = app.config['METRICS_MULTIPROCESS_DIR']
+    if directory:
+        snapshot_writer.write(directory)
+        SnapshotWriter.archive_dead(directory)
+        families = merge(SnapshotWriter.read_all(directory))
+    else:
+        families = merge([registry.collect()])
+    add_hit_ratios(families)
+    return Response(render(families), mimetype='text/plain; version=0.0.4')
@@ -1,22 +1,25 @@
 from datetime import datetime, timedelta
 from api import db, app
-from flask import url_for
+from flask import url_for, request, abort
 # Werkzeug implements password hashing - the password is transformed into a long encoded string 
 # through a series of cryptographic operations that have no known reverse operation, which means 
 # that a person that obtains the hashed password will be unable to use it to obtain the original password.
-# The verification process is done with a second function from Werkzeug
-from werkzeug.security import generate_password_hash, check_password_hash
+# The hashes are computed by the password hasher, in a pool of background processes.
+from api.hashing import password_hasher
 # Flask-Login provides class called UserMixin that includes generic implementations that are appropriate for most user model classes
 from flask_login import UserMixin
 from api import login
-# MD5 hashes of the user's email address and generates profile avatars
-from hashlib import md5
 from time import time
 # JSON Web Token
 import jwt
 import json, base64, os
 import sqlalchemy as sa
 from sqlalchemy import orm as so
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from api.cache import token_cache
+from api.conditional import etag_for, check_not_modified
+from api.serializers import serialize_user, serialize_post, serialize_message, avatar_url
 
 
 
@@ -37,33 +40,168 @@ followers = db.Table('followers',
 
 # PaginatedAPIMixin class implemented in a generic way, that any models that need pagination can inherit from
 class PaginatedAPIMixin(object):
-    @staticmethod
+    # Columns used by the keyset (cursor) pagination, in sort order, and whether the collection is sorted newest first.
+    # Models override these, for example posts are paged on (timestamp, id) from the newest to the oldest.
+    cursor_columns = ('id',)
+    cursor_descending = False
+
+    # The items_to_dicts() method serializes a whole page of items. Models that need extra data for their representation
+    # override it to load that data for the page at once, instead of running queries for every item.
+    @classmethod
+    def items_to_dicts(cls, items):
+        return [item.to_dict() for item in items]
+
+    @classmethod
     # The to_collection_dict() method produces a dictionary with the user collection representation, including the items, _meta and _links sections
     # The first three arguments are a Flask-SQLAlchemy query object, a page number and a page size - determine what are the items that are going to be returned.
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    # When conditional is set, the request is answered with 304 Not Modified before the items are serialized if the client has this version of the page.
+    def to_collection_dict(cls, query, page, per_page, endpoint, conditional=False, **kwargs):
         # The paginate() method of the query object obtains a page worth of items
         resources = query.paginate(page=page, per_page=per_page,
                                    error_out=False)
+        # The page and the page size are the ones paginate() used, it replaces the ones that are out of range
+        return cls.page_to_dict(resources.items, resources.page, resources.per_page, resources.total,
+                                endpoint, conditional=conditional, **kwargs)
+
+    # The page_to_dict() method builds the representation of a page of items that was already loaded, given the total number of items. 
+    # It is shared by to_collection_dict() and the async views, which load the page themselves.
+    @classmethod
+    def page_to_dict(cls, items, page, per_page, total, endpoint, conditional=False, **kwargs):
+        if conditional:
+            cls.check_collection_not_modified(items, total)
+        pages = -(-total // per_page) if total else 0
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.items_to_dicts(items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total
+                'total_pages': pages,
+                'total_items': total
             },
             '_links': {
                 # kwargs - additional keyword arguments
                 'self': url_for(endpoint, page=page, per_page=per_page,
                                 **kwargs),
                 'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                                **kwargs) if resources.has_next else None,
+                                **kwargs) if page < pages else None,
                 'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                                **kwargs) if resources.has_prev else None
+                                **kwargs) if page > 1 else None
             }
         }
         return data
 
+    # The to_cursor_collection_dict() method is the keyset version of to_collection_dict(). Instead of an OFFSET and a COUNT(*) for every page,
+    # it continues from the position stored in an opaque cursor, so deep pages cost the same as the first one.
+    # The cursor is an empty string (or None) for the first page, and the next and prev links carry the cursors of the neighbouring pages.
+    # The total number of items is only counted when include_total is set.
+    # The order argument replaces the model's own cursor columns with a list of (column, attribute name) pairs, the attribute being read from the items.
+    @classmethod
+    def to_cursor_collection_dict(cls, query, cursor, per_page, endpoint,
+                                  include_total=False, order=None,
+                                  descending=None, conditional=False, **kwargs):
+        if order is None:
+            order = [(getattr(cls, name), name) for name in cls.cursor_columns]
+        if descending is None:
+            descending = cls.cursor_descending
+        columns = [column for column, name in order]
+        direction, values = decode_cursor(cursor, columns)
+        # A prev cursor walks the index in the opposite direction, the page is then put back in the collection order
+        forward = direction != 'prev'
+        ascending = forward != descending
+        paged = query.order_by(None)
+        if values is not None:
+            key = sa.tuple_(*columns) if len(columns) > 1 else columns[0]
+            position = sa.tuple_(*values) if len(values) > 1 else values[0]
+            paged = paged.filter(key > position if ascending else key < position)
+        paged = paged.order_by(*[column.asc() if ascending else column.desc()
+                                 for column in columns])
+        # One extra row tells if there is anything after this page without having to count
+        items = paged.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if not forward:
+            items.reverse()
+        if conditional:
+            cls.check_collection_not_modified(items, has_more)
+
+        def item_cursor(item, direction):
+            return encode_cursor([getattr(item, name) for column, name in order], direction)
+
+        has_next = has_more if forward else values is not None
+        has_prev = values is not None if forward else has_more
+        data = {
+            'items': cls.items_to_dicts(items),
+            '_meta': {
+                'per_page': per_page,
+                'cursor': cursor or None
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor or '', per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=item_cursor(items[-1], 'next'),
+                                per_page=per_page, **kwargs)
+                if has_next and items else None,
+                'prev': url_for(endpoint, cursor=item_cursor(items[0], 'prev'),
+                                per_page=per_page, **kwargs)
+                if has_prev and items else None
+            }
+        }
+        if include_total:
+            data['_meta']['total_items'] = query.order_by(None).count()
+        return data
+
+    # The collection_from_request() method picks the pagination mode from the query string of the current request.
+    # Clients that send a cursor argument (an empty one starts at the beginning) get keyset pagination, everyone else the page numbers.
+    # The order and descending arguments are passed on to to_cursor_collection_dict(), and conditional to both methods.
+    @classmethod
+    def collection_from_request(cls, query, endpoint, order=None, descending=None,
+                                conditional=False, **kwargs):
+        per_page = min(request.args.get('per_page', 10, type=int), 100)
+        if 'cursor' in request.args:
+            return cls.to_cursor_collection_dict(
+                query, request.args.get('cursor'), per_page, endpoint,
+                include_total=request.args.get('include_total', 0, type=int) == 1,
+                order=order, descending=descending, conditional=conditional, **kwargs)
+        page = request.args.get('page', 1, type=int)
+        return cls.to_collection_dict(query, page, per_page, endpoint,
+                                      conditional=conditional, **kwargs)
+
+    # The check_collection_not_modified() method computes the entity tag of a page from the request URL and the etag_parts() of the items, 
+    # plus any extra value that changes the representation (like the total number of items). 
+    # The pages have no Last-Modified date, no column records when an item was last edited or deleted, 
+    # so a date taken from the items would let a client keep a stale page.
+    @classmethod
+    def check_collection_not_modified(cls, items, *extra):
+        etag = etag_for(request.full_path, extra, [item.etag_parts() for item in items])
+        check_not_modified(etag)
+
+
+# Cursors are opaque to the clients, they are the sort key of the first or last item of a page and the direction to walk in,
+# JSON encoded and then base64 encoded so that they can be used in a URL as they are.
+def encode_cursor(values, direction):
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    payload = json.dumps({'k': values, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# decode_cursor() returns the direction and the sort key stored in a cursor, or ('next', None) for the first page.
+# Cursors that can't be decoded abort the request with a 400 error.
+def decode_cursor(cursor, columns):
+    if not cursor:
+        return 'next', None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        direction, values = payload['d'], payload['k']
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            raise ValueError(cursor)
+        values = [datetime.fromisoformat(value)
+                  if isinstance(column.type, sa.DateTime) and value is not None else value
+                  for column, value in zip(columns, values)]
+    except (ValueError, KeyError, TypeError):
+        abort(400, description='invalid cursor')
+    return direction, values
+
 # The User class inherits from db.Model, a base class for all models from Flask-SQLAlchemy. 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -75,6 +213,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # adding a token attribute to the user model
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    # Administrators can export the data of all the users. The flag is only set on the server, with the flask set-admin command, 
+    # the API never changes it.
+    is_admin = db.Column(db.Boolean, default=False, server_default=sa.false(), nullable=False)
+    # Denormalized counters, kept in sync when users follow and unfollow each other and when posts are created or deleted.
+    # Reading them is much cheaper than counting the posts and the followers association table for every user.
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     # db.relationship is not an actual database field, but a high-level view of the relationship between users and posts
     # For a one-to-many relationship, a db.relationship field is normally defined on the "one" side, 
@@ -112,6 +258,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # The last_message_read_time field will have the last time the user visited the messages page, and will be used to determine if there are 
     # unread messages, which will all have a timestamp newer than this field.
     last_message_read_time = db.Column(db.DateTime)
+    # The unread_count field is the number of messages received after last_message_read_time. 
+    # It is incremented in the transaction that inserts a message and reset when the user visits the messages page.
+    unread_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     # Relationship with the notification model
     notifications = db.relationship('Notification', backref='user',
@@ -124,27 +273,69 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # With the two methods below, a user object is now able to do secure password verification, 
     # without the need to ever store original passwords.
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
+    # When the password is correct but the hash was made with old parameters, the password is hashed again 
+    # with the current ones. The new hash is saved with the next commit.
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if self.password_hash is None or not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     # The avatar() method of the User class returns the URL of the user's avatar image, scaled to the requested size in pixels.
     def avatar(self, size):
         # To generate the MD5 hash, first need to convert the email to lower case, as this is required by the Gravatar service. 
         # Then, because the MD5 support in Python works on bytes and not on strings, encode the string as bytes before passing it on to the hash function
         # For users that don't have an avatar registered, an "identicon" image will be generated
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        # The digests are memoized per email address by the serializers
+        return avatar_url(self.email, size)
     
     # The follow() and unfollow() methods use the append() and remove() methods of the relationship object
+    # They also update the followed counter of this user and the follower counter of the other user.
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            User.adjust_counter(self.id, 'followed_count', 1)
+            User.adjust_counter(user.id, 'follower_count', 1)
+            TimelineEntry.add_author(self.id, user.id)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            User.adjust_counter(self.id, 'followed_count', -1)
+            User.adjust_counter(user.id, 'follower_count', -1)
+            TimelineEntry.remove_author(self.id, user.id)
+
+    # The adjust_counter() method changes one of the denormalized counters of a user with an UPDATE statement in the current transaction, 
+    # the new value is computed by the database so that concurrent changes are not lost. Users loaded in the session get the new value too.
+    @staticmethod
+    def adjust_counter(id, name, delta):
+        column = getattr(User, name)
+        db.session.execute(sa.update(User).where(User.id == id).values(
+            {column: column + delta}))
+
+    # The reconcile_counters() method recomputes the denormalized counters of all users from the posts and followers tables, 
+    # in a single bulk UPDATE that only touches the users whose counters have drifted. It returns the number of repaired users.
+    @staticmethod
+    def reconcile_counters():
+        post_count = sa.select(sa.func.count(Post.id)).where(
+            Post.user_id == User.id).scalar_subquery()
+        follower_count = sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.followed_id == User.id).scalar_subquery()
+        followed_count = sa.select(sa.func.count()).select_from(followers).where(
+            followers.c.follower_id == User.id).scalar_subquery()
+        result = db.session.execute(
+            sa.update(User).where(sa.or_(
+                User.post_count != post_count,
+                User.follower_count != follower_count,
+                User.followed_count != followed_count)).values(
+                    post_count=post_count,
+                    follower_count=follower_count,
+                    followed_count=followed_count),
+            execution_options={'synchronize_session': 'fetch'})
+        return result.rowcount
 
     # The is_following() method issues a query on the followed relationship to check if a link between two users already exists. 
     def is_following(self, user):
@@ -152,18 +343,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             followers.c.followed_id == user.id).count() > 0
     
     # Query to obtain the posts from followed users
+    # The home timeline of every user is materialized in the timeline_entry table: a post is added to the timelines of its author 
+    # and of all the followers when it is created, and the timeline is backfilled or cleaned up when the user follows or unfollows someone. 
+    # Reading the timeline is a single range scan of the (user_id, timestamp) index, no matter how many users are followed.
+    # The posts are sorted by the timestamp in descending order - the first result will be the most recent post
     def followed_posts(self):
-        # First query that returns followed posts by the user 
-        # With the join() the database to creates a temporary table that combines data from posts and followers tables
-        # The filter() call selects the items in the joined table that have the follower_id column set to this user (keep only the entries that have this user as a follower)
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        # Second query that returns the user's own posts
-        own = Post.query.filter_by(user_id=self.id)
-        # The "union" operator to combine the two queries into a single one.
-        # order_by query sorts the results by the timestamp field of the post in descending order - the first result will be the most recent post
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).filter(
+            TimelineEntry.user_id == self.id).order_by(
+                TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc())
 
     def followed_posts_select(self):
         Author = so.aliased(User)
@@ -190,45 +377,67 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         # If the token is valid, then the value of the reset_password key from the token's payload is the ID of the user, so I can load the user and return it.
         return User.query.get(id)
 
-    # The new_messages() helper method actually uses last_message_read_time field to return how many unread messages the user has.
+    # The new_messages() helper method returns how many unread messages the user has, as kept in the unread_count counter.
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return self.unread_count
+
+    # The conversations() method returns a query with one row for every user this user exchanged messages with: 
+    # the other user, the last message of the conversation, the number of messages and how many of them are unread 
+    # (received after last_message_read_time), newest conversation first. The sent and received messages are read from 
+    # the (sender_id, recipient_id, timestamp) and (recipient_id, sender_id, timestamp) indexes, grouped by the other user, 
+    # and the last message of every conversation is looked up in the same indexes.
+    def conversations(self):
+        if self.last_message_read_time is None:
+            unread = sa.literal(1)
+        else:
+            unread = sa.case((Message.timestamp > self.last_message_read_time, 1), else_=0)
+        sent = sa.select(Message.recipient_id.label('user_id'), Message.timestamp,
+                         sa.literal(0).label('unread')).where(Message.sender_id == self.id)
+        # Messages to oneself are only counted once, as sent messages
+        received = sa.select(Message.sender_id, Message.timestamp, unread).where(
+            Message.recipient_id == self.id, Message.sender_id != self.id)
+        messages = sa.union_all(sent, received).subquery()
+        threads = sa.select(
+            messages.c.user_id,
+            sa.func.max(messages.c.timestamp).label('last_timestamp'),
+            sa.func.count().label('message_count'),
+            sa.func.sum(messages.c.unread).label('unread_count')
+        ).group_by(messages.c.user_id).subquery()
+        last = so.aliased(Message)
+        last_message_id = sa.select(sa.func.max(last.id)).where(
+            sa.or_(sa.and_(last.sender_id == self.id, last.recipient_id == threads.c.user_id),
+                   sa.and_(last.sender_id == threads.c.user_id, last.recipient_id == self.id)),
+            last.timestamp == threads.c.last_timestamp).scalar_subquery()
+        return sa.select(User, Message, threads.c.message_count, threads.c.unread_count).join(
+            threads, User.id == threads.c.user_id).join(Message, Message.id == last_message_id).order_by(
+            threads.c.last_timestamp.desc(), threads.c.user_id.desc())
+
+    # The messages exchanged with another user, in both directions
+    def conversation_with(self, user_id):
+        return Message.query.filter(sa.or_(
+            sa.and_(Message.sender_id == self.id, Message.recipient_id == user_id),
+            sa.and_(Message.sender_id == user_id, Message.recipient_id == self.id)))
     
-    # This method not only adds a notification for the user to the database, but also ensures that if a notification with the same name already exists, it is removed first.
+    # This method adds a notification for the user, replacing the notification with the same name if there is one.
+    # The notification is only recorded in the session, and written when the session is committed with a single upsert 
+    # (see write_notifications() below), so adding the same notification several times in a request results in one write of the last value. 
+    # A new user is flushed first, so that the notification is recorded with its id.
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        if self.id is None:
+            db.session.flush()
+        db.session.info.setdefault('pending_notifications', {})[(self.id, name)] = {
+            'name': name, 'data': data, 'timestamp': time()}
+
+    # The etag_parts() method returns the fields the representation of the user is built from, they are used to compute its entity tag
+    def etag_parts(self):
+        return [self.id, self.username, self.email, self.about_me, self.last_seen,
+                self.post_count, self.follower_count, self.followed_count]
 
     # to_dict() method converts a user object to a Python representation, which will then be converted to JSON
     def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            # last_seen field is generated through the isoformat() method
-            # The Z at the end is ISO 8601's timezone code for UTC
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            # Hypermedia links
-            # url_for() is used to generate the URLs (which currently point to the placeholder view functions, defined in users.py)
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'followed': url_for('api.get_followed', id=self.id),
-                'avatar': self.avatar(128)
-            }
-        }
+        # The representation is built by serialize_user(), with the hypermedia links made from the link templates.
         # Include the email only when users request their own data
-        # include_email flag to determine if that field gets included in the representation or not
-        if include_email:
-            data['email'] = self.email
-        return data
+        return serialize_user(self, include_email)
     
     # from_dict() method that achieves the conversion from a Python dictionary to a model
     def from_dict(self, data, new_user=False):
@@ -243,10 +452,13 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # The get_token() method returns a token for the user. The token is generated as a random string that is encoded in base64 so that all the characters 
     # are in the readable range. Before a new token is created, this method checks if a currently assigned token has at least a minute left before expiration, 
     # and in that case the existing token is returned.
+    # The token that is replaced is removed from the token cache right away.
     def get_token(self, expires_in=3600):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        if self.token:
+            token_cache.delete(self.token)
         self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -254,20 +466,43 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     # When working with tokens it is always good to have a strategy to revoke a token immediately, instead of only relying on the expiration date
     # The revoke_token() method makes the token currently assigned to the user invalid, simply by setting the expiration date to one second before the current time.
+    # The token is also removed from the token cache, so that it stops working immediately.
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        token_cache.delete(self.token)
 
     # The check_token() method is a static method that takes a token as input and returns the user this token belongs to as a response. 
     # If the token is invalid or expired, the method returns None.
+    # Valid tokens are kept in the token cache until they expire (or the cache TTL runs out), for those the user is rebuilt 
+    # from the cached fields without a query. Any other field of the user is loaded from the database the first time it is used.
     @staticmethod
     def check_token(token):
+        now = datetime.utcnow()
+        cached = token_cache.get(token)
+        if cached is not None:
+            if cached['token_expiration'] < now:
+                token_cache.delete(token)
+                return None
+            user = User(**cached)
+            so.make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
         user = User.query.filter_by(token=token).first()
-        if user is None or user.token_expiration < datetime.utcnow():
+        if user is None or user.token_expiration < now:
             return None
+        token_cache.set(token, {
+            'id': user.id,
+            'username': user.username,
+            'token': user.token,
+            'token_expiration': user.token_expiration
+        }, ttl=(user.token_expiration - now).total_seconds())
         return user
 
 # The new Post class will represent listings posted by users   
-class Post(db.Model):
+class Post(PaginatedAPIMixin, db.Model):
+    # Listings are paged from the newest to the oldest
+    cursor_columns = ('timestamp', 'id')
+    cursor_descending = True
+
     id = db.Column(db.Integer, primary_key=True)
     post_title = db.Column(db.String(50))
     description = db.Column(db.String(200))
@@ -277,20 +512,86 @@ class Post(db.Model):
     price = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    # The composite index on the price and the timestamp serves the price range filters and the listings sorted by price
+    __table_args__ = (
+        db.Index('ix_post_price_timestamp', 'price', 'timestamp'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.post_title)
+
+    # Order used by the keyset pagination of the listings sorted by price, from the cheapest post to the most expensive one
+    price_order = [(price, 'price'), (timestamp, 'timestamp'), (id, 'id')]
+
+    # The filter_by_price() method narrows a query of posts to a price range, any of the two limits can be None
+    @staticmethod
+    def filter_by_price(query, min_price=None, max_price=None):
+        if min_price is not None:
+            query = query.filter(Post.price >= min_price)
+        if max_price is not None:
+            query = query.filter(Post.price <= max_price)
+        return query
+
+    # The price_histogram() method counts the posts in price buckets of the given size with a single grouped query.
+    # It returns a list of (bucket number, count) pairs, bucket n holds the prices from n * bucket_size to (n + 1) * bucket_size - 1.
+    @staticmethod
+    def price_histogram(bucket_size, min_price=None, max_price=None):
+        bucket = (Post.price // bucket_size).label('bucket')
+        query = Post.filter_by_price(db.session.query(bucket, sa.func.count()),
+                                     min_price, max_price)
+        return query.group_by(bucket).order_by(bucket).all()
+
+    # The search() method returns a query with the posts that match the search text, best matches first.
+    # The matching is done by the post_fts full-text index, and the posts are ranked with its BM25 function, 
+    # where a match in the title weighs more than a match in the description.
+    # Every word of the text is quoted, so that the FTS5 query syntax can't be injected, and all the words must match.
+    @staticmethod
+    def search(text):
+        match = ' '.join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+        return Post.query.join(post_fts, post_fts.c.rowid == Post.id).filter(
+            sa.text('post_fts MATCH :match').bindparams(match=match)).order_by(
+                sa.text('bm25(post_fts, 10.0, 1.0)'))
+
+    # The rebuild_search_index() method fills the full-text index again from the post table, 
+    # it is needed for posts that were written before the index existed.
+    @staticmethod
+    def rebuild_search_index():
+        db.session.execute(sa.text("INSERT INTO post_fts(post_fts) VALUES ('rebuild')"))
+
+    # The etag_parts() method returns the fields the representation of the post is built from, they are used to compute its entity tag
+    def etag_parts(self):
+        return [self.id, self.post_title, self.description, self.price,
+                self.timestamp, self.user_id]
+
+    # to_dict() method converts a post object to a Python representation, which will then be converted to JSON
+    def to_dict(self):
+        return serialize_post(self)
     
     
 # Message model extends the database to support private messages
 # There are two user foreign keys, one for the sender and one for the recipient. The User model can get relationships for these two users, 
 # plus a new field that indicates what was the last time users read their private messages
-class Message(db.Model):
+class Message(PaginatedAPIMixin, db.Model):
+    # Messages are paged from the newest to the oldest
+    cursor_columns = ('timestamp', 'id')
+    cursor_descending = True
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    # The conversations are read from these indexes, from both sides
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_sender_id_timestamp', 'recipient_id', 'sender_id', 'timestamp'),
+        db.Index('ix_message_sender_id_recipient_id_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+    )
+
+    # to_dict() method converts a message object to a Python representation, which will then be converted to JSON
+    def to_dict(self):
+        return serialize_message(self)
+
 
 # Notification model to keep track of notifications for all users
 # A notification is going to have a name, an associated user, a Unix timestamp and a payload
@@ -303,6 +604,169 @@ class Notification(db.Model):
     # as that will allow me to write lists, dictionaries or single values such as numbers or strings.
     payload_json = db.Column(db.Text)
 
+    # A user has at most one notification with a given name, the unique index is the conflict target of the upserts
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),
+    )
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    # Each notification is given as a dictionary with three elements, the notification name, the additional data 
+    # that pertains to the notification (such as the message count), and the timestamp.
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
+
+# The notifications added during a transaction are written right before it is committed, with one INSERT ... ON CONFLICT DO UPDATE 
+# statement for all of them. The unique index on (user_id, name) makes a new notification replace the previous one with the same name. 
+# Databases without an upsert in upsert_dialects delete the previous notifications and insert the new ones.
+upsert_dialects = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+
+@sa.event.listens_for(db.session, 'before_commit')
+def write_notifications(session):
+    pending = session.info.get('pending_notifications')
+    if not pending:
+        return
+    rows = [{
+        'user_id': user_id,
+        'name': name,
+        'payload_json': json.dumps(notification['data']),
+        'timestamp': notification['timestamp']
+    } for (user_id, name), notification in pending.items()]
+    dialect_insert = upsert_dialects.get(session.get_bind().dialect.name)
+    if dialect_insert is None:
+        for user_id, name in pending:
+            session.execute(sa.delete(Notification.__table__).where(
+                Notification.__table__.c.user_id == user_id, Notification.__table__.c.name == name))
+        session.execute(sa.insert(Notification.__table__), rows)
+        return
+    insert = dialect_insert(Notification.__table__)
+    session.execute(insert.values(rows).on_conflict_do_update(
+        index_elements=['user_id', 'name'],
+        set_={'payload_json': insert.excluded.payload_json,
+              'timestamp': insert.excluded.timestamp}))
+
+
+# The unread counter of the recipient is incremented in the same transaction that inserts the message. 
+# The UPDATE returns the new value, which is copied to the recipient object if it is loaded, so that reading it doesn't need a query.
+@sa.event.listens_for(Message, 'after_insert')
+def message_inserted(mapper, connection, message):
+    user = User.__table__
+    unread_count = connection.execute(
+        sa.update(user).where(user.c.id == message.recipient_id).values(
+            unread_count=user.c.unread_count + 1).returning(user.c.unread_count)).scalar()
+    recipient = sa.inspect(message).dict.get('recipient')
+    if recipient is not None and unread_count is not None:
+        so.attributes.set_committed_value(recipient, 'unread_count', unread_count)
+
+
+# Full-text index over the title and the description of the posts, using the SQLite FTS5 extension. 
+# It is an external content table, it only stores the index and reads the text from the post table, and triggers keep it in sync. 
+# The update trigger only fires when the title or the description change, not on the price edits. 
+# The statements run when the post table is created, the migrations create the same objects for existing databases.
+post_fts = sa.table('post_fts', sa.column('rowid'))
+
+POST_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "post_title, description, content='post', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts(rowid, post_title, description) "
+    "VALUES (new.id, new.post_title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+    "VALUES ('delete', old.id, old.post_title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF post_title, description ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+    "VALUES ('delete', old.id, old.post_title, old.description); "
+    "INSERT INTO post_fts(rowid, post_title, description) "
+    "VALUES (new.id, new.post_title, new.description); END"
+]
+
+for statement in POST_SEARCH_DDL:
+    sa.event.listen(Post.__table__, 'after_create',
+                    sa.DDL(statement).execute_if(dialect='sqlite'))
+sa.event.listen(Post.__table__, 'before_drop',
+                sa.DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite'))
+
+
+# The TimelineEntry model is the materialized home timeline of the users. There is a row for every post that appears 
+# in the timeline of a user, that is the user's own posts and the posts of the followed users, with a copy of the post timestamp 
+# so that the timeline can be read in order from the index.
+class TimelineEntry(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_timeline_entry_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),
+    )
+
+    # Order used by the keyset pagination of the timelines, the entries are read straight from the index
+    cursor_order = [(timestamp, 'timestamp'), (post_id, 'id')]
+
+    # The insert_ignore() method returns an INSERT statement that skips the entries that are already in a timeline, 
+    # with the ON CONFLICT DO NOTHING clause of the dialect of the connection
+    @staticmethod
+    def insert_ignore(connection):
+        return upsert_dialects[connection.dialect.name](TimelineEntry.__table__).on_conflict_do_nothing()
+
+    # The fan_out() method adds the posts that match the condition to the timelines of their authors and of their followers. 
+    # It runs as one INSERT ... SELECT on the given connection, so it works for a single new post as well as for a batch of them.
+    @staticmethod
+    def fan_out(connection, condition):
+        post = Post.__table__
+        connection.execute(TimelineEntry.insert_ignore(connection).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.union_all(
+                sa.select(post.c.user_id, post.c.id, post.c.timestamp).where(condition),
+                sa.select(followers.c.follower_id, post.c.id, post.c.timestamp).select_from(
+                    post.join(followers, followers.c.followed_id == post.c.user_id)).where(condition))))
+
+    # The add_author() and remove_author() methods backfill or clean up the timeline of a user when an author is followed or unfollowed
+    @staticmethod
+    def add_author(user_id, author_id):
+        db.session.execute(TimelineEntry.insert_ignore(db.session.connection()).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(sa.literal(user_id), Post.id, Post.timestamp).where(
+                Post.user_id == author_id)))
+
+    @staticmethod
+    def remove_author(user_id, author_id):
+        # The user's own posts stay in the timeline
+        if user_id == author_id:
+            return
+        db.session.execute(sa.delete(TimelineEntry).where(
+            TimelineEntry.user_id == user_id,
+            TimelineEntry.post_id.in_(sa.select(Post.id).where(Post.user_id == author_id))))
+
+
+# The post counter of the author and the timelines are updated in the same transaction that inserts or deletes a post, 
+# so they stay in sync no matter where the post is created.
+@sa.event.listens_for(Post, 'after_insert')
+def post_inserted(mapper, connection, post):
+    connection.execute(sa.update(User.__table__).where(User.__table__.c.id == post.user_id).values(
+        post_count=User.__table__.c.post_count + 1))
+    TimelineEntry.fan_out(connection, Post.__table__.c.id == post.id)
+
+
+# The timelines keep a copy of the post timestamp, it is updated when the timestamp of the post changes
+@sa.event.listens_for(Post, 'after_update')
+def post_updated(mapper, connection, post):
+    if sa.inspect(post).attrs.timestamp.history.has_changes():
+        connection.execute(sa.update(TimelineEntry.__table__).where(
+            TimelineEntry.__table__.c.post_id == post.id).values(timestamp=post.timestamp))
+
+
+@sa.event.listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, post):
+    connection.execute(sa.update(User.__table__).where(User.__table__.c.id == post.user_id).values(
+        post_count=User.__table__.c.post_count - 1))
+    connection.execute(sa.delete(TimelineEntry.__table__).where(
+        TimelineEntry.__table__.c.post_id == post.id))
+
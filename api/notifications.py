@@ -0,0 +1,112 @@
+# Real time delivery of the notifications with Server-Sent Events.
+# Instead of polling the /notifications route, a client can keep a single connection open to /notifications/stream, 
+# and the notifications are pushed to it as they are added. The notifications are handed over through an in-process hub, 
+# the open streams wait on their queues and cost no database queries while the user is idle. 
+# The hub only reaches the streams of the same process, with several server processes a client only gets the notifications 
+# produced by the process it is connected to, and the since argument of /notifications can be used to catch up.
+
+import json
+from threading import Lock
+from queue import Queue, Empty, Full
+import sqlalchemy as sa
+from flask import Response, request
+from flask_login import current_user, login_required
+from api import app, db
+from api.models import Notification
+
+
+class NotificationHub(object):
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        # Every user id maps to the set of queues of the user's open streams
+        self.subscribers = {}
+        self.lock = Lock()
+
+    # A stream can pass its own queue, any object with the put_nowait() and get_nowait() methods of a queue.Queue
+    def subscribe(self, user_id, queue=None):
+        if queue is None:
+            queue = Queue(self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self.lock:
+            queues = self.subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[user_id]
+
+    # The publish() method never blocks, when a stream is too slow to keep up its oldest notification is dropped. 
+    # Notifications are snapshots (a new one replaces the previous one with the same name), so the newest ones are the ones that matter.
+    def publish(self, user_id, notification):
+        with self.lock:
+            queues = list(self.subscribers.get(user_id, ()))
+        for queue in queues:
+            while True:
+                try:
+                    queue.put_nowait(notification)
+                    break
+                except Full:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        pass
+
+
+notification_hub = NotificationHub(app.config['NOTIFICATION_QUEUE_SIZE'])
+
+
+# add_notification() records the notifications in the session, they are written right before the transaction is committed 
+# and published only after it is committed, so that the streams never see a notification that was rolled back.
+@sa.event.listens_for(db.session, 'after_commit')
+def publish_notifications(session):
+    for (user_id, name), notification in session.info.pop('pending_notifications', {}).items():
+        notification_hub.publish(user_id, notification)
+
+
+@sa.event.listens_for(db.session, 'after_rollback')
+def discard_notifications(session):
+    session.info.pop('pending_notifications', None)
+
+
+# The notification events use the timestamp as the event id, so a client that reconnects sends it back in the Last-Event-ID header 
+# and continues where it stopped.
+def format_event(notification):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        notification['timestamp'], notification['name'], json.dumps(notification['data']))
+
+
+# Route that streams the notifications of the logged in user. The stream starts with the notifications newer than the since argument 
+# (or the Last-Event-ID header), read once from the database, and then sends every new notification as it is committed. 
+# A comment line is sent every NOTIFICATION_STREAM_KEEPALIVE seconds so that proxies don't close an idle connection.
+@app.route('/notifications/stream')
+@login_required
+def notification_stream():
+    user_id = current_user.id
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    # Subscribe before reading the current notifications, so that nothing committed in between is missed
+    queue = notification_hub.subscribe(user_id)
+    initial = [n.to_dict() for n in current_user.notifications.filter(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    # The stream doesn't need the database anymore, the connection goes back to the pool
+    db.session.close()
+    keepalive = app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    def stream():
+        for notification in initial:
+            yield format_event(notification)
+        while True:
+            try:
+                notification = queue.get(timeout=keepalive)
+            except Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(notification)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: notification_hub.unsubscribe(user_id, queue))
+    return response
@@ -0,0 +1,41 @@
+from flask import jsonify, request
+from api import app
+from api.models import Post
+from api.errors import bad_request
+from api.database import read_only
+
+# Full-text search over the book listings
+# The q argument of the query string has the words to look for, all of them must appear in the title or in the description of a listing.
+# The results are ranked by relevance, so they are paginated with page numbers.
+@app.route('/search', methods=['GET'])
+@read_only
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return bad_request('must include a search query in the q argument')
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    data = Post.to_collection_dict(Post.search(q), page, per_page, 'search', q=q)
+    return jsonify(data)
+
+
+# Price histogram of the listings, for the price slider of the frontend
+# The posts are counted in buckets of bucket_size, the min_price and max_price arguments limit the range like in the listings.
+@app.route('/posts/price-histogram', methods=['GET'])
+@read_only
+def price_histogram():
+    bucket_size = request.args.get('bucket_size', app.config['PRICE_HISTOGRAM_BUCKET_SIZE'], type=int)
+    if bucket_size < 1:
+        return bad_request('bucket_size must be a positive number')
+    min_price = request.args.get('min_price', type=int)
+    max_price = request.args.get('max_price', type=int)
+    buckets = [{
+        'min_price': bucket * bucket_size,
+        'max_price': (bucket + 1) * bucket_size - 1,
+        'count': count
+    } for bucket, count in Post.price_histogram(bucket_size, min_price, max_price)]
+    return jsonify({
+        'bucket_size': bucket_size,
+        'buckets': buckets,
+        'total_items': sum(bucket['count'] for bucket in buckets)
+    })
@@ -0,0 +1,83 @@
+# Sampling request profiler.
+# A fraction of the requests (PROFILE_SAMPLE_RATE, 0 disables the profiler) runs under cProfile, and the profile of every 
+# sampled request is written as a .pstats file in a directory per endpoint under PROFILE_DIR. Only the newest PROFILE_MAX_FILES 
+# profiles of every endpoint are kept. The flask profile-report command adds up the profiles of every endpoint 
+# and shows its hottest functions.
+
+import os
+import re
+import pstats
+import random
+import cProfile
+from time import time
+from flask import g, request
+from api import app
+
+# Columns of the profile report, and their index in the statistics of a function kept by pstats
+SORT_KEYS = {'calls': 1, 'tottime': 2, 'cumtime': 3}
+
+
+@app.before_request
+def start_profiler():
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate <= 0 or random.random() >= rate:
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already running in this thread
+        return
+    g.profiler = profiler
+
+
+# The profile is written when the request is torn down, so it includes the requests that failed
+@app.teardown_request
+def stop_profiler(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        save_profile(profiler, request.endpoint or 'unknown')
+    except OSError:
+        app.logger.exception('Could not save the profile of %s', request.path)
+
+
+def profile_dir(endpoint):
+    return os.path.join(app.config['PROFILE_DIR'], re.sub(r'[^\w.-]', '_', endpoint))
+
+
+# The save_profile() function writes the profile of a request, and deletes the oldest profiles of the endpoint. 
+# The file names start with the time in microseconds, so they sort by age.
+def save_profile(profiler, endpoint):
+    directory = profile_dir(endpoint)
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, '{:016d}-{}.pstats'.format(int(time() * 1000000), os.getpid())))
+    paths = sorted(name for name in os.listdir(directory) if name.endswith('.pstats'))
+    for name in paths[:-app.config['PROFILE_MAX_FILES']]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+# The profile_report() function returns, for every endpoint with saved profiles, the number of profiles 
+# and the top functions sorted by the given column, as (function, calls, tottime, cumtime) tuples.
+def profile_report(top, sort='cumtime'):
+    report = {}
+    root = app.config['PROFILE_DIR']
+    if not os.path.isdir(root):
+        return report
+    for endpoint in sorted(os.listdir(root)):
+        directory = os.path.join(root, endpoint)
+        if not os.path.isdir(directory):
+            continue
+        paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.pstats')]
+        if not paths:
+            continue
+        stats = pstats.Stats(*paths)
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][SORT_KEYS[sort]], reverse=True)[:top]
+        report[endpoint] = (len(paths), [(pstats.func_std_string(function), calls, tottime, cumtime)
+                                         for function, (primitive_calls, calls, tottime, cumtime, callers) in functions])
+    return report
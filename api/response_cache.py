@@ -0,0 +1,106 @@
+# Response cache for the public listings.
+# The first pages of /explore and /homefeed are the same for every visitor, so their responses are cached in memory, 
+# keyed by the route and the query string arguments, in a bounded cache with a time to live. 
+# Any insert, update or delete of a post clears the cache once it is committed. The cache is per process, 
+# with several server processes a change made in another process is only seen when the entries expire (RESPONSE_CACHE_TTL).
+
+from functools import wraps
+from threading import Lock
+import sqlalchemy as sa
+from flask import request, g
+from api import app, db
+from api.cache import TTLCache
+from api.conditional import check_not_modified
+from api.models import Post
+
+
+class ResponseCache(object):
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize, ttl)
+        # Hits and misses of every route
+        self.routes = {}
+        # The generation is incremented every time the cache is cleared
+        self.generation = 0
+        self.lock = Lock()
+
+    def record(self, endpoint, hit):
+        with self.lock:
+            counters = self.routes.setdefault(endpoint, [0, 0])
+            counters[0 if hit else 1] += 1
+
+    # The key of the current request, its endpoint and its query string arguments
+    def key(self):
+        return (request.endpoint, tuple(sorted(request.args.items(multi=True))))
+
+    # The lookup() method returns the cached response for the key, or None. The validators of the view 
+    # (see check_not_modified()) are stored with the response, so a client that already has the page still gets a 304 response.
+    def lookup(self, key):
+        entry = self.cache.get(key)
+        self.record(key[0], entry is not None)
+        if entry is None:
+            return None
+        data, mimetype, validators = entry
+        if validators is not None:
+            check_not_modified(*validators)
+        return app.response_class(data, mimetype=mimetype)
+
+    # Only successful responses are stored. A request that read the posts before a commit cleared the cache 
+    # would store a page without that change, so the response is only stored if the cache wasn't cleared since 
+    # the generation the request started with.
+    def store(self, key, response, generation):
+        if response.status_code != 200:
+            return
+        entry = (response.get_data(), response.mimetype, g.get('validators'))
+        with self.lock:
+            if self.generation == generation:
+                self.cache.set(key, entry)
+
+    # The cached() decorator serves the view from the cache
+    def cached(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = self.key()
+            generation = self.generation
+            response = self.lookup(key)
+            if response is None:
+                response = app.make_response(f(*args, **kwargs))
+                self.store(key, response, generation)
+            return response
+        return decorated
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+
+    # The stats() method returns the hits, misses and hit ratio of every route
+    def stats(self):
+        with self.lock:
+            return {endpoint: {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits / (hits + misses) if hits + misses else None
+            } for endpoint, (hits, misses) in self.routes.items()}
+
+
+listing_cache = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+
+
+# Changes to the posts are marked in the session, and the cache is cleared after the transaction that made them is committed. 
+# Code that writes posts without the ORM (like the bulk import) sets the posts_changed flag itself.
+@sa.event.listens_for(Post, 'after_insert')
+@sa.event.listens_for(Post, 'after_update')
+@sa.event.listens_for(Post, 'after_delete')
+def post_changed(mapper, connection, post):
+    sa.orm.object_session(post).info['posts_changed'] = True
+
+
+@sa.event.listens_for(db.session, 'after_commit')
+def clear_listing_cache(session):
+    if session.info.pop('posts_changed', False):
+        listing_cache.clear()
+
+
+@sa.event.listens_for(db.session, 'after_rollback')
+def discard_posts_changed(session):
+    session.info.pop('posts_changed', None)
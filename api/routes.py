@@ -1,13 +1,16 @@
-from mmap import PAGESIZE
 from api import app, db
 from api.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm
 from api.forms import ResetPasswordForm, MessageForm
 from flask import jsonify, redirect, url_for, request
 from flask_login import current_user, login_user, logout_user, login_required
-from api.models import Post, User, Message, Notification
+from api.models import Post, User, Message, Notification, TimelineEntry
 from werkzeug.urls import url_parse
 from datetime import datetime
+import sqlalchemy as sa
 from api.email import send_password_reset_email
+from api.last_seen import last_seen_buffer
+from api.response_cache import listing_cache
+from api.database import read_only
 
 @app.route('/', methods=['GET', 'POST'])
 
@@ -24,61 +27,57 @@ def index():
         # Redirecting is to avoid re-submitting the form like re-fresh page does
         return redirect(url_for('index'))
     # Display real posts
-    # Determine the page number to display, either from the page query string argument or a default 
-    # of 1, and then use the paginate() method to retrieve only the desired page of results.
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    # The next_url and prev_url in these two view functions are going to be set to a URL returned by 
-    # url_for() only if there is a page in that direction.
-    next_url = url_for('index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) \
-        if posts.has_prev else None
-    # TODO ---------
-    return 
+    # The posts come from the materialized timeline of the user, either a page given by the page number or the page after a cursor.
+    # The next and prev links of the collection are set only if there is a page in that direction.
+    return jsonify(Post.collection_from_request(
+        current_user.followed_posts(), 'index', order=TimelineEntry.cursor_order))
+
+# The listings of posts accept the min_price and max_price arguments to only return posts in that price range, 
+# and the sort=price argument to list the cheapest posts first instead of the newest ones. 
+# The arguments are carried over to the next and prev links of the collection. 
+# The listings support conditional requests, a client that already has the page gets a 304 response.
+def listing_collection(endpoint):
+    min_price = request.args.get('min_price', type=int)
+    max_price = request.args.get('max_price', type=int)
+    sort = request.args.get('sort')
+    query = Post.filter_by_price(Post.query, min_price, max_price)
+    filters = {name: value for name, value in (
+        ('min_price', min_price), ('max_price', max_price), ('sort', sort))
+        if value is not None}
+    if sort == 'price':
+        query = query.order_by(Post.price.asc(), Post.timestamp.asc(), Post.id.asc())
+        return Post.collection_from_request(query, endpoint, order=Post.price_order,
+                                            descending=False, conditional=True, **filters)
+    query = query.order_by(Post.timestamp.desc())
+    return Post.collection_from_request(query, endpoint, conditional=True, **filters)
+
 
 @app.route('/homefeed', methods=['GET'])
+@read_only
+# The pages of the listing are served from the response cache while no post changes
+@listing_cache.cached
 def homefeed():
-    # Determine the page number to display, either from the page query string argument or a default 
-    # of 1, and then use the paginate() method to retrieve only the desired page of results.
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    # The next_url and prev_url in these two view functions are going to be set to a URL returned by 
-    # url_for() only if there is a page in that direction.
-    next_url = url_for('explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    # TODO ---------
-    return posts
+    # The page number (or the cursor for the keyset pagination) is taken from the query string, and only the desired page of results is retrieved.
+    # The next and prev links of the collection are set only if there is a page in that direction.
+    return jsonify(listing_collection('homefeed'))
 
 
 @app.route('/userfeed', methods=['GET'])
+@read_only
 @login_required
 def userfeed():
     """Retrieve the user's post feed"""
-    user = current_user().paginate(
-        page=PAGESIZE, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    return user.followed_posts_select()
+    return jsonify(Post.collection_from_request(
+        current_user.followed_posts(), 'userfeed', order=TimelineEntry.cursor_order))
 
 # Works like the home page, but it shows posts from all user, instead of only the followed ones
 @app.route('/explore')
+@read_only
+@listing_cache.cached
 def explore():
-    # Determine the page number to display, either from the page query string argument or a default 
-    # of 1, and then use the paginate() method to retrieve only the desired page of results.
-    page = request.args.get('page', 1, type=int)
-    posts = Post.select().all().paginate(
-        page=page, per_page=app.config['POSTS_PER_PAGE'], error_out=False)
-    # The next_url and prev_url in these two view functions are going to be set to a URL returned by 
-    # url_for() only if there is a page in that direction.
-    next_url = url_for('explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    
-    return posts
+    # The page number (or the cursor for the keyset pagination) is taken from the query string, and only the desired page of results is retrieved.
+    # The next and prev links of the collection are set only if there is a page in that direction.
+    return jsonify(listing_collection('explore'))
 
 # The methods argument in the route decorator tells Flask that this view function 
 # accepts GET and POST requests, overriding the default, which is to accept only GET requests.
@@ -104,6 +103,8 @@ def login():
         # If the username and password are both correct, then the login_user() function will register the user as logged in, 
         # so that means that any future pages the user navigates to will have the current_user variable set to that user.
         login_user(user, remember=form.remember_me.data)
+        # Saves the password hash if check_password() had to rehash it
+        db.session.commit()
         # Right after the user is logged in, the value of the next query string argument is obtained. 
         # Flask provides a request variable that contains all the information that the client sent with the request - request.args
         next_page = request.args.get('next')
@@ -184,11 +185,10 @@ def user(username):
 # This is code that I want to execute before any view function in the application, and I can have it in a single place.
 @app.before_request
 def before_request():
-    # checks if the current_user is logged in, and in that case sets the last_seen field to the current time
+    # checks if the current_user is logged in, and in that case records the current time as the last_seen field
+    # The time goes through the write-behind buffer, which writes the visits of all users in batches instead of committing on every request
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        # Commit the database session, so that the change made above is written to the database
-        db.session.commit()
+        last_seen_buffer.touch(current_user._get_current_object(), datetime.utcnow())
 
 
 # Edit profile view function
@@ -296,8 +296,9 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
-        db.session.commit()
-        # Update notifications for the user
+        # The flush inserts the message and increments the unread counter of the recipient
+        db.session.flush()
+        # Update notifications for the user, in the same transaction as the message
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         return redirect(url_for('main.user', username=recipient))
@@ -309,22 +310,64 @@ def send_message(recipient):
 @app.route('/messages')
 @login_required
 def messages():
-    # update the User.last_message_read_time field with the current time
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
+    # update the User.last_message_read_time field with the current time and reset the unread counter. 
+    # The counter is recounted in the UPDATE statement itself, so a message that arrives in the meantime stays unread 
+    # instead of being wiped by a blind reset to zero.
+    now = datetime.utcnow()
+    current_user.last_message_read_time = now
+    current_user.unread_count = sa.select(sa.func.count(Message.id)).where(
+        Message.recipient_id == current_user.id, Message.timestamp > now).scalar_subquery()
+    db.session.flush()
+    current_user.add_notification('unread_message_count', current_user.unread_count)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
     # Querying the Message model for the list of messages, sorted by timestamp from newer to older.
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page=page, per_page=app.config['MESSAGES_PER_PAGE'],
-            error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    # TODO -------
-    return 
+    return jsonify(Message.collection_from_request(
+        current_user.messages_received.order_by(Message.timestamp.desc()), 'messages'))
+
+# The conversations of the logged in user, one per user they exchanged messages with, newest first. 
+# Every conversation has the other user, the last message, the number of messages and the unread ones, all from one query.
+# Pages are given by page numbers, one extra row tells if there is a next page.
+@app.route('/conversations')
+@login_required
+def conversations():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    rows = db.session.execute(current_user.conversations().limit(per_page + 1).offset(
+        (page - 1) * per_page)).all()
+    return jsonify({
+        'items': [{
+            'user': {
+                'id': user.id,
+                'username': user.username,
+                'avatar': user.avatar(128)
+            },
+            'last_message': message.to_dict(),
+            'message_count': message_count,
+            'unread_count': unread_count,
+            '_links': {
+                'messages': url_for('conversation', id=user.id)
+            }
+        } for user, message, message_count, unread_count in rows[:per_page]],
+        '_meta': {
+            'page': page,
+            'per_page': per_page
+        },
+        '_links': {
+            'self': url_for('conversations', page=page, per_page=per_page),
+            'next': url_for('conversations', page=page + 1, per_page=per_page) if len(rows) > per_page else None,
+            'prev': url_for('conversations', page=page - 1, per_page=per_page) if page > 1 else None
+        }
+    })
+
+# The messages of one conversation, newest first. They are always paged with cursors, so going back in a long thread 
+# continues from the position in the (sender_id, recipient_id, timestamp) indexes.
+@app.route('/conversations/<int:id>')
+@login_required
+def conversation(id):
+    user = db.get_or_404(User, id)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    return jsonify(Message.to_cursor_collection_dict(
+        current_user.conversation_with(user.id), request.args.get('cursor'), per_page, 'conversation', id=user.id))
 
 # Route that the client can use to retrieve notifications for the logged in user
 @app.route('/notifications')
@@ -337,9 +380,5 @@ def notifications():
     # as a floating point number. Only notifications that occurred after this time will be returned if this argument is included.
     since = request.args.get('since', 0.0, type=float)
     notifications = current_user.notifications.filter(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    return jsonify([n.to_dict() for n in notifications])
 
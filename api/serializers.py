@@ -0,0 +1,119 @@
+# Serialization of the models for the API responses.
+# Building the links of every item with url_for() matches the URL rules again for every link, so the links are built from templates instead:
+# url_for() is called once per endpoint with a sentinel id, and the URL is split around it into a prefix and a suffix.
+# The avatar URLs need the MD5 digest of the email address, the digests are memoized per email.
+# The to_dict() methods of the models delegate to the serializer functions below.
+# The responses can also be encoded with orjson instead of the json module of the standard library,
+# by setting JSON_BACKEND to orjson (orjson is an optional dependency).
+
+from functools import lru_cache
+from hashlib import md5
+from flask import url_for, request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from api import app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Id given to url_for() to find where the id goes in the URL, it can't appear anywhere else in a URL of the application
+LINK_SENTINEL = 9876543210123
+
+
+# The link_template() function returns the prefix and the suffix of the URLs of an endpoint.
+# The URLs start with the script root of the application, so the templates are cached for every script root.
+@lru_cache(maxsize=128)
+def link_template(endpoint, script_root):
+    url = url_for(endpoint, id=LINK_SENTINEL)
+    prefix, suffix = url.split(str(LINK_SENTINEL))
+    return prefix, suffix
+
+
+def link(endpoint, id):
+    prefix, suffix = link_template(endpoint, request.script_root if has_request_context() else '')
+    return prefix + str(id) + suffix
+
+
+@lru_cache(maxsize=app.config['AVATAR_CACHE_SIZE'])
+def avatar_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def avatar_url(email, size):
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(avatar_digest(email), size)
+
+
+def serialize_user(user, include_email=False):
+    data = {
+        'id': user.id,
+        'username': user.username,
+        # The Z at the end is ISO 8601's timezone code for UTC
+        'last_seen': user.last_seen.isoformat() + 'Z',
+        'about_me': user.about_me,
+        'post_count': user.post_count,
+        'follower_count': user.follower_count,
+        'followed_count': user.followed_count,
+        '_links': {
+            'self': link('get_user', user.id),
+            'followers': link('get_followers', user.id),
+            'followed': link('get_followed', user.id),
+            'avatar': avatar_url(user.email, 128)
+        }
+    }
+    if include_email:
+        data['email'] = user.email
+    return data
+
+
+def serialize_post(post):
+    return {
+        'id': post.id,
+        'post_title': post.post_title,
+        'description': post.description,
+        'price': post.price,
+        'timestamp': post.timestamp.isoformat() + 'Z',
+        '_links': {
+            'author': link('get_user', post.user_id)
+        }
+    }
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'body': message.body,
+        'timestamp': message.timestamp.isoformat() + 'Z',
+        '_links': {
+            'author': link('get_user', message.sender_id),
+            'recipient': link('get_user', message.recipient_id)
+        }
+    }
+
+
+# JSON provider that encodes with orjson. The values orjson doesn't know, and the dates (which Flask encodes as HTTP dates),
+# go through the default() function of Flask, so the responses have the same content as with the json module. 
+# The values orjson can't encode at all (integers wider than 64 bits) and the options it doesn't have are left to the json module.
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+if app.config['JSON_BACKEND'] == 'orjson':
+    if orjson is None:
+        app.logger.warning('JSON_BACKEND is orjson but orjson is not installed, using the json module')
+    else:
+        app.json = OrjsonProvider(app)
@@ -1,6 +1,7 @@
 from flask import jsonify
 from api import app, db
 from api.auth import basic_auth, token_auth
+from api.cache import token_cache
 
 # Generate user tokens
 @app.route('/tokens', methods=['POST'])
@@ -14,6 +15,9 @@ def get_token():
 @app.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
-    token_auth.current_user().revoke_token()
+    user = token_auth.current_user()
+    user.revoke_token()
     db.session.commit()
+    # Drop the token from the cache again once the revocation is committed, in case another request cached it in the meantime
+    token_cache.delete(user.token)
     return '', 204
\ No newline at end of file
@@ -3,45 +3,48 @@ from api import app, db
 from api.models import User
 from api.errors import bad_request
 from api.auth import token_auth
+from api.conditional import etag_for, check_not_modified
+from api.database import read_only
 
 # Retrieve a single user, given by id
 # The view function receives the id for the requested user as a dynamic argument in the URL.
 @app.route('/users/<int:id>', methods=['GET'])
+@read_only
 @token_auth.login_required
 def get_user(id):
     # The advantage of get_or_404() over get() is that it removes the need to check the result of the query -
     # when the id does not exist, it aborts the request and returns a 404 error to the client.
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.query.get_or_404(id)
+    # Clients that already have this version of the user get a 304 response
+    check_not_modified(etag_for(user.etag_parts()))
+    return jsonify(user.to_dict())
 
 # Return the collection of all users.
 @app.route('/users', methods=['GET'])
+@read_only
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    # The page and per_page arguments are then passed to the to_collection_query() method, along with the query, 
+    # The page (or cursor) and per_page arguments are read by the collection_from_request() method, along with the query, 
     # which in this case is simply User.query, the most generic query that returns all users.
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
+    data = User.collection_from_request(User.query, 'get_users', conditional=True)
     return jsonify(data)
 
 # Endpoint that returns the followers
 @app.route('/users/<int:id>/followers', methods=['GET'])
+@read_only
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id)
+    data = User.collection_from_request(user.followers, 'get_followers', id=id)
     return jsonify(data)
 
 # Endpoint that returns the followed users
 @app.route('/users/<int:id>/followed', methods=['GET'])
+@read_only
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', id=id)
+    data = User.collection_from_request(user.followed, 'get_followed', id=id)
     return jsonify(data)
 
 # The POST request to the /users route is going to be used to register new user accounts.
@@ -66,7 +69,7 @@ def create_user():
     # The response that returned for this request is going to be the representation of the new user
     response = jsonify(user.to_dict())
     response.status_code = 201
-    response.headers['Location'] = url_for('api.get_user', id=user.id)
+    response.headers['Location'] = url_for('get_user', id=user.id)
     return response
 
 # Endpoint to modify user
@@ -0,0 +1,347 @@
+# ASGI entry point, run it with an ASGI server, for example: uvicorn asgi:application
+# The read-heavy JSON endpoints (GET /users, /explore and /notifications) run as async views on an async SQLAlchemy engine
+# (aiosqlite for SQLite), so a request waiting for the database doesn't hold a thread and the number of concurrent requests
+# is only bounded by memory. The notification stream is also served on the event loop, an open stream doesn't hold a thread either.
+# Every other request, and the requests these views don't handle (cursor pagination, price filters,
+# a missing or invalid login), go to the Flask application, which runs in the thread pool of the event loop through asgiref.
+# The async views run inside a Flask request context built from the ASGI request, so they share the URL rules, the session cookie,
+# the serializers, the response cache and the request hooks (validators, CORS, metrics, profiling) with the Flask views.
+
+import io
+import sys
+import asyncio
+from datetime import datetime
+from queue import Empty
+import sqlalchemy as sa
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from flask import request, session, jsonify
+from flask_login.utils import decode_cookie
+from api import app
+from api.models import User, Post, Notification
+from api.cache import token_cache
+from api.database import add_sqlite_pragmas
+from api.response_cache import listing_cache
+from api.metrics import instrument_engine
+from api.instrumentation import sql_instrumentation
+from api.notifications import notification_hub, format_event
+
+
+# The async engine uses ASYNC_DATABASE_URL, by default the SQLite database of the application with the aiosqlite driver
+def async_database_url():
+    if app.config['ASYNC_DATABASE_URL']:
+        return app.config['ASYNC_DATABASE_URL']
+    url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite':
+        raise RuntimeError('ASYNC_DATABASE_URL must be set for {} databases'.format(url.get_backend_name()))
+    return url.set(drivername='sqlite+aiosqlite')
+
+
+def create_engine():
+    engine = create_async_engine(async_database_url(), **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if engine.dialect.name == 'sqlite':
+        add_sqlite_pragmas(app, engine.sync_engine)
+    return engine
+
+
+# The WSGI environ of an ASGI request, without a body (the async views only answer GET requests)
+def build_environ(scope):
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope['http_version']),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+# The page and page size of the request, out of range values are replaced like paginate() does
+def page_args():
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    return max(page, 1), per_page if per_page > 0 else 20
+
+
+# The token_user_id() function returns the id of the owner of the bearer token of the request, or None.
+# It shares the token cache with User.check_token().
+async def token_user_id(db_session):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    now = datetime.utcnow()
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached['id'] if cached['token_expiration'] >= now else None
+    user = (await db_session.execute(sa.select(User.id, User.username, User.token, User.token_expiration).where(
+        User.token == token))).first()
+    if user is None or user.token_expiration < now:
+        return None
+    token_cache.set(token, user._asdict(), ttl=(user.token_expiration - now).total_seconds())
+    return user.id
+
+
+# The async views return a response, or None to let the Flask application handle the request
+async def get_users(db_session):
+    if 'cursor' in request.args or await token_user_id(db_session) is None:
+        return None
+    page, per_page = page_args()
+    total = await db_session.scalar(sa.select(sa.func.count()).select_from(User))
+    users = await db_session.scalars(sa.select(User).limit(per_page).offset((page - 1) * per_page))
+    return jsonify(User.page_to_dict(users.all(), page, per_page, total, 'get_users', conditional=True))
+
+
+async def explore(db_session):
+    if any(name in request.args for name in ('cursor', 'min_price', 'max_price', 'sort')):
+        return None
+    key = listing_cache.key()
+    generation = listing_cache.generation
+    response = listing_cache.lookup(key)
+    if response is not None:
+        return response
+    page, per_page = page_args()
+    total = await db_session.scalar(sa.select(sa.func.count()).select_from(Post))
+    posts = await db_session.scalars(sa.select(Post).order_by(Post.timestamp.desc()).limit(
+        per_page).offset((page - 1) * per_page))
+    response = jsonify(Post.page_to_dict(posts.all(), page, per_page, total, 'explore', conditional=True))
+    listing_cache.store(key, response, generation)
+    return response
+
+
+# The logged in user is read from the session cookie, like Flask-Login does. Clients that only have a remember me cookie, 
+# and sessions of users that no longer exist, go through Flask-Login.
+async def notifications(db_session):
+    user_id = session.get('_user_id')
+    if user_id is None or await db_session.get(User, int(user_id)) is None:
+        return None
+    since = request.args.get('since', 0.0, type=float)
+    notifications = await db_session.scalars(sa.select(Notification).where(
+        Notification.user_id == int(user_id), Notification.timestamp > since).order_by(Notification.timestamp.asc()))
+    return jsonify([n.to_dict() for n in notifications])
+
+
+# Queue of a stream served on the event loop. The hub publishes from the thread that committed the notification,
+# so the notifications are handed over to the event loop, where the oldest one is dropped when the stream is too slow.
+# put_nowait() never raises Full, so the hub never calls get_nowait().
+class StreamQueue(object):
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, notification):
+        self.loop.call_soon_threadsafe(self.put, notification)
+
+    def put(self, notification):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(notification)
+
+    def get_nowait(self):
+        raise Empty
+
+    async def get(self):
+        return await self.queue.get()
+
+
+# A response whose body is sent chunk by chunk from an async iterator, until the iterator ends or the client disconnects
+class StreamingResponse(app.response_class):
+    def __init__(self, body, **kwargs):
+        super().__init__(**kwargs)
+        self.async_body = body
+
+
+# The notification stream of /notifications/stream (see api/notifications.py), waiting on the hub without a thread.
+# Like Flask-Login, the user is read from the session cookie or else from the remember me cookie, and the streams
+# of anonymous users go to the Flask view, which rejects them right away.
+async def notification_stream(db_session):
+    user_id = session.get('_user_id') or decode_cookie(request.cookies.get(
+        app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'), ''))
+    if user_id is None or await db_session.get(User, int(user_id)) is None:
+        return None
+    user_id = int(user_id)
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    # Subscribe before reading the current notifications, so that nothing committed in between is missed
+    queue = notification_hub.subscribe(user_id, StreamQueue(asyncio.get_running_loop(), app.config['NOTIFICATION_QUEUE_SIZE']))
+    initial = [n.to_dict() for n in await db_session.scalars(sa.select(Notification).where(
+        Notification.user_id == user_id, Notification.timestamp > since).order_by(Notification.timestamp.asc()))]
+    keepalive = app.config['NOTIFICATION_STREAM_KEEPALIVE']
+
+    async def stream():
+        try:
+            for notification in initial:
+                yield format_event(notification)
+            while True:
+                try:
+                    notification = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_event(notification)
+        finally:
+            notification_hub.unsubscribe(user_id, queue)
+
+    return StreamingResponse(stream(), mimetype='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+ASYNC_VIEWS = {
+    'get_users': get_users,
+    'explore': explore,
+    'notifications': notifications,
+    'notification_stream': notification_stream
+}
+
+
+# The WSGI wrapper of asgiref runs the application with sync_to_async() in its default thread sensitive mode,
+# which runs every request on one shared thread, so a slow request (or a stream) would hold up all the others.
+# The Flask views don't need a particular thread, they run in the thread pool of the event loop instead. 
+# The whole request runs in one thread, so start_response() is called in the thread of the application, as in asgiref.
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self.serve, thread_sensitive=False)(body)
+
+    def serve(self, body):
+        try:
+            environ = self.build_environ(self.scope, body)
+        except ValueError:
+            # Too many duplicate headers
+            self.sync_send({'type': 'http.response.start', 'status': 400, 'headers': [(b'content-type', b'text/plain')]})
+            self.sync_send({'type': 'http.response.body', 'body': b'Bad Request'})
+            return
+        output = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in output:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                self.sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({'type': 'http.response.body'})
+
+
+class AsyncApplication(object):
+    def __init__(self, flask_app, engine):
+        self.flask_app = flask_app
+        self.engine = engine
+        self.sessions = async_sessionmaker(engine, expire_on_commit=False)
+        # The statements of the async views are timed like the ones of the Flask views
+        instrument_engine(engine.sync_engine)
+        if self.flask_app.config['SQL_INSTRUMENTATION']:
+            sql_instrumentation.enable([engine.sync_engine])
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            response = await self.dispatch(scope)
+            if isinstance(response, StreamingResponse):
+                await self.send_stream(response, receive, send)
+                return
+            if response is not None:
+                await self.send_response(response, send)
+                return
+        await ThreadPoolWsgiInstance(self.flask_app)(scope, receive, send)
+
+    # The request is matched against the URL rules of the Flask application to find its async view. 
+    # The view runs between the before_request and the after_request hooks of the application, and the request 
+    # is torn down afterwards, like a request of a Flask view. The hooks are synchronous and run on the event loop, 
+    # a request handed over to the Flask application runs them again there.
+    async def dispatch(self, scope):
+        ctx = self.flask_app.request_context(build_environ(scope))
+        error = None
+        ctx.push()
+        try:
+            view = ASYNC_VIEWS.get(request.endpoint)
+            if view is None:
+                return None
+            try:
+                try:
+                    response = self.flask_app.preprocess_request()
+                    if response is None:
+                        async with self.sessions() as db_session:
+                            response = await view(db_session)
+                        if response is None:
+                            return None
+                except Exception as e:
+                    response = self.flask_app.handle_user_exception(e)
+                return self.flask_app.finalize_request(response)
+            except Exception as e:
+                error = e
+                return self.flask_app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def send_start(self, response, send):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()]
+        })
+
+    async def send_response(self, response, send):
+        await self.send_start(response, send)
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    # The body is sent while waiting for the client to disconnect, the stream is then cancelled, which closes the iterator
+    async def send_stream(self, response, receive, send):
+        async def send_body():
+            await self.send_start(response, send)
+            async for chunk in response.async_body:
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body'})
+
+        async def wait_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(send_body()), asyncio.ensure_future(wait_disconnect())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await response.async_body.aclose()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = AsyncApplication(app, create_engine())
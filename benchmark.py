@@ -0,0 +1,311 @@
+import os
+import sys
+import argparse
+import tempfile
+# The benchmark runs against its own database, by default a SQLite file in a temporary directory,
+# so the DATABASE_URL environment variable has to be set before the application is imported.
+# The command line is only parsed when the script is run, importing the module uses the default options.
+parser = argparse.ArgumentParser(description='Benchmark the endpoints of the application against a synthetic dataset.')
+parser.add_argument('--users', type=int, default=1000, help='number of users')
+parser.add_argument('--posts', type=int, default=10000, help='number of posts')
+parser.add_argument('--messages', type=int, default=5000, help='number of private messages')
+parser.add_argument('--follow-exponent', type=float, default=1.5,
+                    help='exponent of the power-law distribution of the number of followed users')
+parser.add_argument('--requests', type=int, default=200, help='measured requests per endpoint')
+parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint')
+parser.add_argument('--per-page', type=int, default=25, help='page size of the collection endpoints')
+parser.add_argument('--seed', type=int, default=42, help='seed of the random generator')
+parser.add_argument('--database', help='database URL, a temporary SQLite file is used by default')
+parser.add_argument('--output', help='write the results as JSON to this file')
+parser.add_argument('--micro', action='store_true',
+                    help='only measure the cost per item of the serializers and the JSON encoders, without a database')
+parser.add_argument('--items', type=int, default=1000, help='items serialized per round of the micro-benchmark')
+parser.add_argument('--rounds', type=int, default=20, help='rounds of the micro-benchmark')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.database is None:
+        args.database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    os.environ['DATABASE_URL'] = args.database
+else:
+    args = parser.parse_args([])
+
+import json
+import random
+import base64
+from time import perf_counter, time
+from datetime import datetime, timedelta
+from hashlib import md5
+import sqlalchemy as sa
+from flask import url_for
+from flask.json.provider import DefaultJSONProvider
+from api import app, db
+from api.models import User, Post, Message, Notification, TimelineEntry, followers
+from api.hashing import password_hasher
+from api.serializers import OrjsonProvider, orjson
+from api.response_cache import listing_cache
+
+# All the users share the same password, so that it only has to be hashed once
+PASSWORD = 'benchmark'
+
+
+# The seed() function fills the database with the synthetic dataset. All the rows are written with bulk (executemany) inserts,
+# and then the denormalized data (counters and timelines) is computed in bulk, like the migrations do for existing databases.
+def seed(rng):
+    now = datetime.utcnow()
+    password_hash = password_hasher.hash(PASSWORD)
+    db.session.execute(sa.insert(User.__table__), [{
+        'username': 'user{}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'password_hash': password_hash,
+        'about_me': 'I am user {}'.format(i),
+        'last_seen': now - timedelta(minutes=rng.randrange(60 * 24 * 30))
+    } for i in range(args.users)])
+    ids = list(range(1, args.users + 1))
+
+    # The number of users that each user follows has a power-law distribution, and the followed users are picked
+    # with a Zipf-like preference, so that a few users have many followers and most users have a few.
+    weights = [1.0 / rank ** args.follow_exponent for rank in range(1, args.users + 1)]
+    follows = set()
+    for follower in ids:
+        degree = min(int(rng.paretovariate(args.follow_exponent)), args.users - 1)
+        for followed in rng.choices(ids, weights=weights, k=degree):
+            if followed != follower:
+                follows.add((follower, followed))
+    db.session.execute(followers.insert(), [
+        {'follower_id': follower, 'followed_id': followed} for follower, followed in follows])
+
+    db.session.execute(sa.insert(Post.__table__), [{
+        'post_title': 'Book {}'.format(i),
+        'description': 'A used copy of book {}, in {} condition'.format(
+            i, rng.choice(['good', 'fair', 'excellent'])),
+        'price': rng.randrange(1, 200),
+        'user_id': rng.choice(ids),
+        'timestamp': now - timedelta(seconds=rng.randrange(60 * 60 * 24 * 365))
+    } for i in range(args.posts)])
+
+    db.session.execute(sa.insert(Message.__table__), [{
+        'sender_id': rng.choice(ids),
+        'recipient_id': rng.choice(ids),
+        'body': 'Is book {} still available?'.format(i),
+        'timestamp': now - timedelta(seconds=rng.randrange(60 * 60 * 24 * 30))
+    } for i in range(args.messages)])
+
+    db.session.execute(sa.insert(Notification.__table__), [{
+        'user_id': id,
+        'name': 'unread_message_count',
+        'payload_json': json.dumps(rng.randrange(10)),
+        'timestamp': time() - rng.randrange(60 * 60 * 24)
+    } for id in ids])
+
+    User.reconcile_counters()
+    TimelineEntry.fan_out(db.session.connection(), sa.true())
+    db.session.execute(sa.update(User).values(unread_count=sa.select(sa.func.count(Message.id)).where(
+        Message.recipient_id == User.id).scalar_subquery()))
+    db.session.commit()
+    return len(follows)
+
+
+# The QueryCounter class counts the SQL statements executed by the application while it is active, 
+# on all the engines (the reads of the read-only views go to the read engine)
+class QueryCounter(object):
+    def __init__(self, engines):
+        self.engines = engines
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        for engine in self.engines:
+            sa.event.listen(engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc_info):
+        for engine in self.engines:
+            sa.event.remove(engine, 'before_cursor_execute', self)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# The measure() function sends the requests of an endpoint through the test client. The prepare function returns the arguments
+# of every request (it runs outside of the measured time), then the latency and the number of queries of every request are recorded.
+# The response cache is cleared before every request, so the listings are measured on their query path.
+def measure(client, engines, prepare):
+    latencies = []
+    queries = []
+    statuses = set()
+    for i in range(args.warmup + args.requests):
+        method, url, kwargs = prepare(i)
+        listing_cache.clear()
+        with QueryCounter(engines) as counter:
+            start = perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            response.get_data()
+            elapsed = perf_counter() - start
+        statuses.add(response.status_code)
+        if i >= args.warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+    return {
+        'requests': args.requests,
+        'status_codes': sorted(statuses),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'queries_max': max(queries)
+    }
+
+
+def run():
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = perf_counter()
+        follow_count = seed(rng)
+        seed_time = perf_counter() - start
+        # The most followed users have the biggest timelines, the requests are spread over them
+        sample = [user.id for user in User.query.order_by(
+            User.follower_count.desc()).limit(20)]
+        tokens = {id: db.session.get(User, id).get_token() for id in sample}
+        db.session.commit()
+        engines = list(db.engines.values())
+
+    client = app.test_client()
+
+    def logged_in(url):
+        def prepare(i):
+            with client.session_transaction() as session:
+                session['_user_id'] = str(sample[i % len(sample)])
+            return 'GET', url, {}
+        return prepare
+
+    def with_token(url):
+        def prepare(i):
+            headers = {'Authorization': 'Bearer ' + tokens[sample[i % len(sample)]]}
+            return 'GET', url, {'headers': headers}
+        return prepare
+
+    def basic_auth(i):
+        credentials = 'user{}:{}'.format(sample[i % len(sample)] - 1, PASSWORD)
+        headers = {'Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
+        return 'POST', '/tokens', {'headers': headers}
+
+    per_page = args.per_page
+    endpoints = {
+        '/users': with_token('/users?per_page={}'.format(per_page)),
+        '/users (cursor)': with_token('/users?cursor=&per_page={}'.format(per_page)),
+        '/explore': lambda i: ('GET', '/explore?per_page={}'.format(per_page), {}),
+        '/explore (cursor)': lambda i: ('GET', '/explore?cursor=&per_page={}'.format(per_page), {}),
+        '/index': logged_in('/index?per_page={}'.format(per_page)),
+        '/messages': logged_in('/messages?per_page={}'.format(per_page)),
+        '/notifications': logged_in('/notifications'),
+        '/tokens': basic_auth
+    }
+    results = {}
+    for name, prepare in endpoints.items():
+        results[name] = measure(client, engines, prepare)
+        print('{:<20} p50 {:>9.3f} ms  p95 {:>9.3f} ms  p99 {:>9.3f} ms  {:>6.2f} queries'.format(
+            name, results[name]['p50_ms'], results[name]['p95_ms'], results[name]['p99_ms'],
+            results[name]['queries_mean']))
+
+    report = {
+        'dataset': {
+            'users': args.users,
+            'follows': follow_count,
+            'posts': args.posts,
+            'messages': args.messages,
+            'follow_exponent': args.follow_exponent,
+            'seed': args.seed,
+            'seed_seconds': round(seed_time, 3)
+        },
+        'requests_per_endpoint': args.requests,
+        'per_page': per_page,
+        'python': sys.version.split()[0],
+        'sqlalchemy': sa.__version__,
+        'endpoints': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+# Representation of a user built with url_for() and a new avatar digest for every item, 
+# the way User.to_dict() worked before the serializers, as the reference of the micro-benchmark
+def user_dict_with_url_for(user):
+    digest = md5(user.email.lower().encode('utf-8')).hexdigest()
+    return {
+        'id': user.id,
+        'username': user.username,
+        'last_seen': user.last_seen.isoformat() + 'Z',
+        'about_me': user.about_me,
+        'post_count': user.post_count,
+        'follower_count': user.follower_count,
+        'followed_count': user.followed_count,
+        '_links': {
+            'self': url_for('get_user', id=user.id),
+            'followers': url_for('get_followers', id=user.id),
+            'followed': url_for('get_followed', id=user.id),
+            'avatar': 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, 128)
+        }
+    }
+
+
+# The per_item() function returns the best time per item in microseconds of a function applied to a list of items
+def per_item(function, items):
+    best = None
+    for i in range(args.rounds):
+        start = perf_counter()
+        function(items)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / len(items) * 1000000, 3)
+
+
+# The micro-benchmark serializes objects that are never written to the database, 
+# so it only measures the serializers and the JSON encoders.
+def run_micro():
+    now = datetime.utcnow()
+    users = [User(id=i, username='user{}'.format(i), email='user{}@example.com'.format(i), about_me='I am user {}'.format(i),
+                  last_seen=now, post_count=i % 50, follower_count=i % 7, followed_count=i % 11)
+             for i in range(1, args.items + 1)]
+    posts = [Post(id=i, post_title='Book {}'.format(i), description='A used copy of book {}'.format(i), price=i % 200,
+                  timestamp=now, user_id=i) for i in range(1, args.items + 1)]
+    messages = [Message(id=i, body='Is book {} still available?'.format(i), timestamp=now, sender_id=i, recipient_id=i + 1)
+                for i in range(1, args.items + 1)]
+    results = {}
+    with app.test_request_context():
+        results['user (url_for)'] = per_item(lambda items: [user_dict_with_url_for(u) for u in items], users)
+        results['user'] = per_item(User.items_to_dicts, users)
+        results['post'] = per_item(Post.items_to_dicts, posts)
+        results['message'] = per_item(Message.items_to_dicts, messages)
+        data = User.items_to_dicts(users)
+        results['encode (json)'] = per_item(DefaultJSONProvider(app).dumps, data)
+        if orjson is not None:
+            results['encode (orjson)'] = per_item(OrjsonProvider(app).dumps, data)
+    for name, microseconds in results.items():
+        print('{:<20} {:>9.3f} us/item'.format(name, microseconds))
+    report = {
+        'items': args.items,
+        'rounds': args.rounds,
+        'python': sys.version.split()[0],
+        'per_item_us': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    if args.micro:
+        run_micro()
+    else:
+        run()
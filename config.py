@@ -5,6 +5,19 @@
 import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# The options of the connection pool are read from the DATABASE_POOL_* environment variables. 
+# Only the options that are set are passed to the engine, the pool of the in-memory SQLite database doesn't accept them all.
+def pool_options():
+    options = {}
+    for name, convert in (('pool_size', int), ('max_overflow', int), ('pool_timeout', float), ('pool_recycle', int)):
+        value = os.environ.get('DATABASE_' + name.upper())
+        if value:
+            options[name] = convert(value)
+    if os.environ.get('DATABASE_POOL_PRE_PING') is not None:
+        options['pool_pre_ping'] = True
+    return options
+
+
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     
@@ -13,6 +26,40 @@ class Config(object):
         'sqlite:///' + os.path.join(basedir, 'app.db')
     # Sending a signal to the application every time a change is about to be made in the database is disabled
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Database of the async views of the ASGI entry point (asgi.py), by default the SQLite database above with the aiosqlite driver
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    # The read-only views can query a separate database, for example a read-only connection to the same file 
+    # (sqlite:///file:app.db?mode=ro&uri=true) or a replica. Without DATABASE_READ_URL everything uses the main database.
+    SQLALCHEMY_BINDS = {'read': os.environ['DATABASE_READ_URL']} if os.environ.get('DATABASE_READ_URL') else {}
+    SQLALCHEMY_ENGINE_OPTIONS = pool_options()
+
+    # With SQL_INSTRUMENTATION set, the SQL statements of every request are counted and timed in a Server-Timing header, 
+    # and the requests that execute the same statement more than SQL_N_PLUS_ONE_THRESHOLD times are logged
+    SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION') is not None
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 10)
+
+    # Fraction of the requests that are profiled, the profiles are saved in PROFILE_DIR, 
+    # keeping the newest PROFILE_MAX_FILES profiles of every endpoint
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES') or 50)
+
+    # With several server processes, every process writes its metrics to this directory (at most every METRICS_SNAPSHOT_INTERVAL seconds) 
+    # and the /metrics endpoint adds them up
+    METRICS_MULTIPROCESS_DIR = os.environ.get('METRICS_MULTIPROCESS_DIR')
+    METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL') or 5)
+
+    # Number of avatar digests memoized by the serializers, and the encoder of the JSON responses 
+    # (json, or orjson if it is installed)
+    AVATAR_CACHE_SIZE = int(os.environ.get('AVATAR_CACHE_SIZE') or 4096)
+    JSON_BACKEND = os.environ.get('JSON_BACKEND') or 'json'
+
+    # Pragmas run on every new SQLite connection
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'
+    # Bytes of the database file mapped in memory, and size of the page cache (negative values are in KiB)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -64000)
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -20,6 +67,41 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # The emails are sent by MAIL_WORKERS background threads, each one sends up to MAIL_BATCH_SIZE emails per SMTP connection. 
+    # At most MAIL_QUEUE_SIZE emails can wait to be sent, when the queue is full the sender waits up to MAIL_QUEUE_TIMEOUT seconds.
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 100)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or 5)
     
+    # The passwords are hashed with PASSWORD_HASH_METHOD (a werkzeug hash method with its cost parameters) by PASSWORD_HASH_WORKERS 
+    # background processes, 0 hashes them in the request thread. When the method changes the passwords are rehashed at the next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+
+    # Bearer tokens are cached in memory after they are verified, these settings are the maximum number of cached tokens 
+    # and the number of seconds a token is trusted without looking it up in the database again.
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 1024)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 60)
+
+    # The last visit time of the users is buffered in memory and written every LAST_SEEN_FLUSH_INTERVAL seconds. 
+    # A visit is only recorded when the stored time is more than LAST_SEEN_TOLERANCE seconds old.
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    LAST_SEEN_TOLERANCE = int(os.environ.get('LAST_SEEN_TOLERANCE') or 60)
+
+    # Every open notification stream buffers up to NOTIFICATION_QUEUE_SIZE notifications, 
+    # and sends a keepalive comment after NOTIFICATION_STREAM_KEEPALIVE idle seconds.
+    NOTIFICATION_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_QUEUE_SIZE') or 100)
+    NOTIFICATION_STREAM_KEEPALIVE = int(os.environ.get('NOTIFICATION_STREAM_KEEPALIVE') or 15)
+
+    # Number of rows fetched from the database at a time by the NDJSON exports
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+
+    # The responses of the public listings are cached in memory, up to RESPONSE_CACHE_SIZE pages for RESPONSE_CACHE_TTL seconds
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE') or 256)
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 30)
+
     POSTS_PER_PAGE = 10
+    # Default width of the price buckets of the price histogram
+    PRICE_HISTOGRAM_BUCKET_SIZE = 10
     MESSAGES_PER_PAGE = 10
\ No newline at end of file
@@ -0,0 +1,35 @@
+"""post search update trigger
+
+Revision ID: 7b4d1e9c2a60
+Revises: 1c5e7f9a3b20
+Create Date: 2026-10-18 18:12:40.215873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b4d1e9c2a60'
+down_revision = '1c5e7f9a3b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The search index is only rewritten when the indexed columns change
+    op.execute('DROP TRIGGER IF EXISTS post_fts_update')
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE OF post_title, description ON post BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+               "VALUES ('delete', old.id, old.post_title, old.description); "
+               "INSERT INTO post_fts(rowid, post_title, description) "
+               "VALUES (new.id, new.post_title, new.description); END")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS post_fts_update')
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE ON post BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+               "VALUES ('delete', old.id, old.post_title, old.description); "
+               "INSERT INTO post_fts(rowid, post_title, description) "
+               "VALUES (new.id, new.post_title, new.description); END")
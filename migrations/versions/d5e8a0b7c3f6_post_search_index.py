@@ -0,0 +1,42 @@
+"""post search index
+
+Revision ID: d5e8a0b7c3f6
+Revises: c41f7d2e9a18
+Create Date: 2026-10-18 11:24:05.907361
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8a0b7c3f6'
+down_revision = 'c41f7d2e9a18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 external content table over the title and the description of the posts, kept in sync by triggers
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+               "post_title, description, content='post', content_rowid='id')")
+    op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+               "INSERT INTO post_fts(rowid, post_title, description) "
+               "VALUES (new.id, new.post_title, new.description); END")
+    op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+               "VALUES ('delete', old.id, old.post_title, old.description); END")
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE ON post BEGIN "
+               "INSERT INTO post_fts(post_fts, rowid, post_title, description) "
+               "VALUES ('delete', old.id, old.post_title, old.description); "
+               "INSERT INTO post_fts(rowid, post_title, description) "
+               "VALUES (new.id, new.post_title, new.description); END")
+    # Index the existing posts
+    op.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS post_fts_update')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_delete')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_insert')
+    op.execute('DROP TABLE IF EXISTS post_fts')
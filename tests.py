@@ -4,9 +4,37 @@ import os
 os.environ['DATABASE_URL'] = 'sqlite://'
 
 from datetime import datetime, timedelta
+from decimal import Decimal
+import io
+import tempfile
+import subprocess
+import threading
+import json
 import unittest
-from api import app, db
-from api.models import User, Post
+from unittest import mock
+from queue import Full
+from flask import url_for
+from flask_mail import Message as MailMessage
+import sqlalchemy as sa
+from api import app, db, mail
+from api.models import User, Post, Message, TimelineEntry, upsert_dialects
+from api.cache import token_cache
+from api.last_seen import LastSeenBuffer
+from api.email import MailQueue, mail_queue
+from api.notifications import notification_hub
+from api.importer import read_rows, import_posts
+from api.export import export_lines
+from api.response_cache import listing_cache
+from api.hashing import PasswordHasher, password_hasher
+from api.instrumentation import sql_instrumentation, start_query_stats
+from api.metrics import Histogram, SnapshotWriter, registry, merge, render
+from api.serializers import link, avatar_digest, OrjsonProvider, orjson
+try:
+    import asyncio
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from asgi import AsyncApplication
+except ImportError:
+    AsyncApplication = None
 
 
 # Four tests that exercise the password hashing, user avatar and followers functionality in the user model. 
@@ -98,5 +126,1272 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(author=u2, price=1, timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+
+        # following backfills the timeline, new posts are fanned out to the followers
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        p2 = Post(author=u3, price=1, timestamp=now + timedelta(seconds=2))
+        p3 = Post(author=u1, price=1, timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+        self.assertEqual(u3.followed_posts().all(), [p2])
+
+        u1.unfollow(u2)
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3])
+
+        # the timelines follow a change of the post timestamp
+        p1.timestamp = now + timedelta(seconds=4)
+        db.session.commit()
+        self.assertEqual(u2.followed_posts().all(), [p1])
+        self.assertEqual(db.session.scalar(sa.select(TimelineEntry.timestamp).where(
+            TimelineEntry.post_id == p1.id)), p1.timestamp)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        u1.follow(u2)
+        db.session.add(Post(author=u2, price=3))
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count), (1, 0))
+        self.assertEqual((u2.follower_count, u2.post_count), (1, 1))
+
+        u1.unfollow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 0)
+        self.assertEqual((u2.follower_count, u2.post_count), (0, 0))
+
+    def test_reconcile_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        # make the counters drift behind the application's back
+        db.session.execute(sa.update(User).values(follower_count=7, post_count=2))
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counters(), 2)
+        db.session.commit()
+        self.assertEqual((u2.follower_count, u2.post_count), (1, 0))
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_unread_count(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add(Message(author=u1, recipient=u2, body='hello'))
+        db.session.flush()
+        self.assertEqual(u2.new_messages(), 1)
+        db.session.add(Message(sender_id=u1.id, recipient_id=u2.id, body='again'))
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 2)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        data = client.get('/messages').get_json()
+        self.assertEqual([m['body'] for m in data['items']], ['again', 'hello'])
+        u2 = db.session.get(User, u2.id)
+        self.assertEqual(u2.new_messages(), 0)
+
+        # a message newer than the read time is still counted after the reset
+        db.session.add(Message(sender_id=u1.id, recipient_id=u2.id, body='later',
+                               timestamp=datetime.utcnow() + timedelta(minutes=1)))
+        db.session.commit()
+        client.get('/messages')
+        db.session.expire_all()
+        self.assertEqual(u2.new_messages(), 1)
+
+
+# Tests for the keyset (cursor) pagination of the API collections.
+class CursorPaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_users_cursor_pages(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].get_token()}
+        db.session.commit()
+
+        first = self.client.get('/users?cursor=&per_page=2', headers=headers).get_json()
+        self.assertEqual([u['username'] for u in first['items']], ['user0', 'user1'])
+        self.assertNotIn('total_items', first['_meta'])
+        self.assertIsNone(first['_links']['prev'])
+
+        second = self.client.get(first['_links']['next'], headers=headers).get_json()
+        self.assertEqual([u['username'] for u in second['items']], ['user2', 'user3'])
+        third = self.client.get(second['_links']['next'], headers=headers).get_json()
+        self.assertEqual([u['username'] for u in third['items']], ['user4'])
+        self.assertIsNone(third['_links']['next'])
+
+        back = self.client.get(third['_links']['prev'], headers=headers).get_json()
+        self.assertEqual([u['username'] for u in back['items']], ['user2', 'user3'])
+
+        counted = self.client.get('/users?cursor=&include_total=1', headers=headers).get_json()
+        self.assertEqual(counted['_meta']['total_items'], 5)
+        bad = self.client.get('/users?cursor=garbage', headers=headers)
+        self.assertEqual(bad.status_code, 400)
+
+    def test_posts_cursor_pages(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        # two posts share a timestamp, the id breaks the tie
+        posts = [Post(author=u, post_title='book {}'.format(i), price=10,
+                      timestamp=now + timedelta(seconds=min(i, 2)))
+                 for i in range(4)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+
+        seen = []
+        url = '/explore?cursor=&per_page=1'
+        while url:
+            data = self.client.get(url).get_json()
+            seen += [p['id'] for p in data['items']]
+            url = data['_links']['next']
+        self.assertEqual(seen, [posts[3].id, posts[2].id, posts[1].id, posts[0].id])
+    def test_users_page_query_count(self):
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[2].follow(users[1])
+        db.session.add(Post(author=users[1], price=5))
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + users[0].get_token()}
+        db.session.commit()
+
+        def count_queries(url):
+            statements = []
+            def record(*args):
+                statements.append(args[2])
+            sa.event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.client.get(url, headers=headers)
+            finally:
+                sa.event.remove(db.engine, 'before_cursor_execute', record)
+            return response.get_json(), len(statements)
+
+        # the first request caches the token
+        count_queries('/users?cursor=&per_page=1')
+        small, small_queries = count_queries('/users?cursor=&per_page=2')
+        large, large_queries = count_queries('/users?cursor=&per_page=6')
+        self.assertEqual(small_queries, large_queries)
+        susan = large['items'][1]
+        self.assertEqual((susan['post_count'], susan['follower_count'], susan['followed_count']),
+                         (1, 2, 0))
+        with app.test_request_context():
+            self.assertEqual(susan, users[1].to_dict())
+
+
+# Tests for the bearer token cache.
+class TokenCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        token_cache.clear()
+        self.client = app.test_client()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.token = u.get_token()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cached_token(self):
+        hits = token_cache.hits
+        self.assertEqual(User.check_token(self.token).username, 'john')
+        db.session.remove()
+        user = User.check_token(self.token)
+        self.assertEqual(token_cache.hits, hits + 1)
+        self.assertEqual(user.username, 'john')
+        self.assertEqual(user.email, 'john@example.com')
+        self.assertIsNone(User.check_token('not a token'))
+
+    def test_revoke_invalidates(self):
+        headers = {'Authorization': 'Bearer ' + self.token}
+        self.assertEqual(self.client.get('/users/1', headers=headers).status_code, 200)
+        self.assertEqual(self.client.delete('/tokens', headers=headers).status_code, 204)
+        self.assertEqual(self.client.get('/users/1', headers=headers).status_code, 401)
+
+    def test_new_token_invalidates(self):
+        user = User.check_token(self.token)
+        user.token_expiration = datetime.utcnow() + timedelta(seconds=30)
+        new_token = user.get_token()
+        db.session.commit()
+        self.assertNotEqual(new_token, self.token)
+        self.assertIsNone(User.check_token(self.token))
+        self.assertEqual(User.check_token(new_token).id, user.id)
+
+
+# Tests for the last_seen write-behind buffer.
+class LastSeenBufferCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_coalesce_and_flush(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        buffer = LastSeenBuffer(interval=3600, tolerance=0)
+        now = datetime.utcnow() + timedelta(hours=1)
+        buffer.touch(u1, now)
+        buffer.touch(u1, now + timedelta(seconds=5))
+        buffer.touch(u2, now)
+        # the session doesn't have anything to write, the visits are in the buffer
+        self.assertFalse(db.session.dirty)
+        self.assertEqual(u1.last_seen, now + timedelta(seconds=5))
+
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.flush(), 0)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now + timedelta(seconds=5))
+        self.assertEqual(u2.last_seen, now)
+
+    def test_tolerance(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        buffer = LastSeenBuffer(interval=3600, tolerance=60)
+        buffer.touch(u, u.last_seen + timedelta(seconds=30))
+        self.assertEqual(buffer.pending, {})
+        buffer.touch(u, u.last_seen + timedelta(seconds=90))
+        self.assertEqual(list(buffer.pending), [u.id])
+
+    def test_flush_on_recent_visit(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        buffer = LastSeenBuffer(interval=3600, tolerance=60)
+        seen = u1.last_seen + timedelta(seconds=90)
+        buffer.touch(u1, seen)
+        # susan's visit is within the tolerance, but the interval is over so john's visit is written anyway
+        buffer.last_flush -= 3600
+        buffer.touch(u2, u2.last_seen + timedelta(seconds=30))
+        self.assertEqual(buffer.pending, {})
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, seen)
+
+
+# Tests for the full-text search of the listings.
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(author=u, price=5, post_title='Dune',
+                  description='A science fiction novel set on a desert planet')
+        p2 = Post(author=u, price=7, post_title='Desert flowers',
+                  description='A field guide')
+        p3 = Post(author=u, price=9, post_title='Cookbook', description='Recipes')
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        # a match in the title ranks higher
+        self.assertEqual(Post.search('desert').all(), [p2, p1])
+        self.assertEqual(Post.search('desert novel').all(), [p1])
+
+        p3.description = 'Recipes from the desert'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertCountEqual(Post.search('desert').all(), [p1, p3])
+
+        data = self.client.get('/search?q=desert&per_page=1').get_json()
+        self.assertEqual(data['_meta']['total_items'], 2)
+        self.assertEqual(data['items'][0]['id'], Post.search('desert').first().id)
+        self.assertIn('q=desert', data['_links']['next'])
+        self.assertEqual(self.client.get('/search?q="').status_code, 200)
+        self.assertEqual(self.client.get('/search').status_code, 400)
+
+
+# Tests for the price filters of the listings.
+class PriceFilterCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        self.posts = [Post(author=u, price=price, timestamp=now + timedelta(seconds=i))
+                      for i, price in enumerate([15, 3, 27, 8, 15, 42])]
+        db.session.add_all([u] + self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_price_range(self):
+        data = self.client.get('/explore?min_price=5&max_price=20').get_json()
+        self.assertEqual([p['price'] for p in data['items']], [15, 8, 15])
+
+    def test_sort_by_price(self):
+        prices = []
+        url = '/explore?cursor=&per_page=2&sort=price&max_price=30'
+        while url:
+            data = self.client.get(url).get_json()
+            prices += [p['price'] for p in data['items']]
+            url = data['_links']['next']
+        self.assertEqual(prices, [3, 8, 15, 15, 27])
+        data = self.client.get('/homefeed?sort=price&page=2&per_page=4').get_json()
+        self.assertEqual([p['price'] for p in data['items']], [27, 42])
+
+    def test_price_histogram(self):
+        data = self.client.get('/posts/price-histogram?bucket_size=10').get_json()
+        self.assertEqual([(b['min_price'], b['count']) for b in data['buckets']],
+                         [(0, 2), (10, 2), (20, 1), (40, 1)])
+        data = self.client.get('/posts/price-histogram?bucket_size=20&min_price=10').get_json()
+        self.assertEqual([(b['min_price'], b['max_price'], b['count']) for b in data['buckets']],
+                         [(0, 19, 2), (20, 39, 1), (40, 59, 1)])
+        self.assertEqual(data['total_items'], 4)
+        self.assertEqual(self.client.get('/posts/price-histogram?bucket_size=0').status_code, 400)
+
+
+# Tests for the mail delivery workers. The mail extension is suppressed, so no email leaves the process, 
+# to try them against a real server point MAIL_SERVER and MAIL_PORT to a local debugging SMTP server.
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.state = app.extensions['mail']
+        self.suppress = self.state.suppress
+        self.state.suppress = True
+
+    def tearDown(self):
+        self.state.suppress = self.suppress
+
+    def message(self, i):
+        return MailMessage('test {}'.format(i), sender='admin@example.com',
+                           recipients=['user{}@example.com'.format(i)], body='hi')
+
+    def test_batches_share_connection(self):
+        queue = MailQueue(app, workers=1, maxsize=10, batch_size=10, timeout=1)
+        # hold the worker until all the emails are queued
+        queue.queue.put(self.message(0))
+        with mock.patch.object(mail, 'connect', wraps=mail.connect) as connect, \
+                mail.record_messages() as outbox:
+            for i in range(1, 5):
+                queue.queue.put(self.message(i))
+            queue.start()
+            queue.join()
+        self.assertEqual(len(outbox), 5)
+        self.assertEqual(connect.call_count, 1)
+
+    def test_backpressure(self):
+        queue = MailQueue(app, workers=0, maxsize=2, batch_size=10, timeout=0.01)
+        queue.put(self.message(0))
+        queue.put(self.message(1))
+        self.assertEqual(queue.qsize(), 2)
+        with self.assertRaises(Full):
+            queue.put(self.message(2))
+
+    # A full queue drops the email, the view answers as usual
+    def test_full_queue_reset_request(self):
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='john', email='john@example.com'))
+            db.session.commit()
+            try:
+                with mock.patch.dict(app.config, {'WTF_CSRF_ENABLED': False}), \
+                        mock.patch.object(mail_queue, 'put', side_effect=Full) as put:
+                    response = app.test_client().post('/reset_password_request', data={'email': 'john@example.com'})
+                self.assertEqual(put.call_count, 1)
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response.headers['Location'].endswith('/login'))
+            finally:
+                db.session.remove()
+                db.drop_all()
+
+
+# Tests for the notification hub and the notification stream.
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_publish_on_commit(self):
+        queue = notification_hub.subscribe(self.user.id)
+        try:
+            self.user.add_notification('unread_message_count', 3)
+            db.session.rollback()
+            self.assertTrue(queue.empty())
+            self.user.add_notification('unread_message_count', 4)
+            self.assertTrue(queue.empty())
+            db.session.commit()
+            self.assertEqual(queue.get_nowait()['data'], 4)
+        finally:
+            notification_hub.unsubscribe(self.user.id, queue)
+
+    def test_coalesced_upsert(self):
+        self.user.add_notification('unread_message_count', 1)
+        db.session.commit()
+        statements = []
+        def record(*args):
+            statements.append(args[2])
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.user.add_notification('unread_message_count', 2)
+            self.user.add_notification('unread_message_count', 3)
+            self.user.add_notification('new_follower', 'susan')
+            db.session.commit()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len([s for s in statements if 'notification' in s]), 1)
+        notifications = {n.name: n.get_data() for n in self.user.notifications}
+        self.assertEqual(notifications, {'unread_message_count': 3, 'new_follower': 'susan'})
+
+    # Databases without an upsert replace the notifications with a delete and an insert
+    def test_other_dialects(self):
+        with mock.patch.dict(upsert_dialects, clear=True):
+            self.user.add_notification('unread_message_count', 1)
+            db.session.commit()
+            self.user.add_notification('unread_message_count', 2)
+            db.session.commit()
+        self.assertEqual([(n.name, n.get_data()) for n in self.user.notifications], [('unread_message_count', 2)])
+
+    def test_new_user(self):
+        user = User(username='susan', email='susan@example.com')
+        db.session.add(user)
+        user.add_notification('unread_message_count', 1)
+        db.session.commit()
+        self.assertEqual([n.get_data() for n in user.notifications], [1])
+
+    def test_stream(self):
+        self.user.add_notification('unread_message_count', 1)
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(self.user.id)
+        response = client.get('/notifications/stream', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+        self.assertIn('data: 1\n', next(events).decode())
+
+        # the stream closed the session it shares with the test
+        self.user = db.session.get(User, self.user.id)
+        self.user.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertIn('data: 2\n', next(events).decode())
+        response.close()
+        self.assertNotIn(self.user.id, notification_hub.subscribers)
+
+
+# Tests for the bulk import of listings.
+class ImportPostsCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_csv(self):
+        seller = User(username='john', email='john@example.com')
+        buyer = User(username='susan', email='susan@example.com')
+        db.session.add_all([seller, buyer])
+        db.session.commit()
+        buyer.follow(seller)
+        db.session.commit()
+        f = io.StringIO('post_title,description,price\n'
+                        'Dune,Science fiction,12\n'
+                        ',No title,3\n'
+                        'Emma,Romance,cheap\n'
+                        'Ulysses,,20\n'
+                        'Beloved,Novel,7\n')
+        rejects = []
+        imported, rejected = import_posts(
+            read_rows(f, 'csv'), seller, chunk_size=2,
+            reject=lambda line, reason, row: rejects.append((line, reason)))
+        self.assertEqual((imported, rejected), (3, 2))
+        self.assertEqual(rejects, [(3, 'post_title is missing'), (4, 'price is not a whole number')])
+        db.session.expire_all()
+        self.assertEqual(seller.post_count, 3)
+        self.assertEqual([p.post_title for p in buyer.followed_posts()],
+                         ['Beloved', 'Ulysses', 'Dune'])
+        self.assertEqual(Post.search('romance').count(), 0)
+        self.assertEqual(Post.search('novel').first().price, 7)
+
+    def test_import_jsonl(self):
+        seller = User(username='john', email='john@example.com')
+        db.session.add(seller)
+        db.session.commit()
+        f = io.StringIO('{"post_title": "Dune", "price": 5}\n\nnot json\n[1]\n')
+        self.assertEqual(import_posts(read_rows(f, 'jsonl'), seller), (1, 2))
+
+    def test_jsonl_prices(self):
+        seller = User(username='john', email='john@example.com')
+        db.session.add(seller)
+        db.session.commit()
+        f = io.StringIO('{"post_title": "Dune", "price": 12.5}\n{"post_title": "Emma", "price": true}\n'
+                        '{"post_title": "Ulysses", "price": 20.0}\n')
+        rejects = []
+        imported, rejected = import_posts(read_rows(f, 'jsonl'), seller,
+                                          reject=lambda line, reason, row: rejects.append((line, reason)))
+        self.assertEqual((imported, rejected), (1, 2))
+        self.assertEqual(rejects, [(1, 'price is not a whole number'), (2, 'price is not a whole number')])
+        self.assertEqual(Post.query.one().price, 20)
+
+
+# Tests for the NDJSON exports.
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_export(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([admin, u] + [Post(author=u, price=i, post_title='book {}'.format(i))
+                                         for i in range(5)])
+        db.session.commit()
+        rows = [json.loads(line) for line in export_lines('posts', batch_size=2)]
+        self.assertEqual([row['price'] for row in rows], [0, 1, 2, 3, 4])
+        self.assertTrue(rows[0]['timestamp'].endswith('Z'))
+
+        headers = {'Authorization': 'Bearer ' + u.get_token()}
+        admin_headers = {'Authorization': 'Bearer ' + admin.get_token()}
+        db.session.commit()
+        self.assertEqual(self.client.get('/export/users', headers=headers).status_code, 403)
+        response = self.client.get('/export/users', headers=admin_headers)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        users = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([user['username'] for user in users], ['admin', 'john'])
+        self.assertNotIn('email', users[0])
+        self.assertEqual(self.client.get('/export/tokens', headers=admin_headers).status_code, 404)
+
+    # The administrators are not known by their email, a user who takes the email of the ADMINS setting is not one
+    def test_admin_email(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        headers = {'Authorization': 'Bearer ' + u.get_token()}
+        db.session.commit()
+        response = self.client.put('/users/{}'.format(u.id), headers=headers, json={'email': app.config['ADMINS'][0]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/export/messages', headers=headers).status_code, 403)
+
+
+# Tests for the conditional requests.
+class ConditionalRequestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + self.user.get_token()}
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_user_etag(self):
+        response = self.client.get('/users/1', headers=self.headers)
+        etag = response.headers['ETag']
+        headers = dict(self.headers, **{'If-None-Match': etag})
+        response = self.client.get('/users/1', headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_data(), b'')
+
+        self.user.about_me = 'Hi'
+        db.session.commit()
+        self.assertEqual(self.client.get('/users/1', headers=headers).status_code, 200)
+        self.assertNotEqual(self.client.get('/users', headers=self.headers).headers['ETag'], etag)
+
+    # The avatar link is made from the email, so a new email gives a new entity tag
+    def test_user_etag_email(self):
+        etag = self.client.get('/users/1', headers=self.headers).headers['ETag']
+        page_etag = self.client.get('/users', headers=self.headers).headers['ETag']
+        self.user.email = 'johnny@example.com'
+        db.session.commit()
+        response = self.client.get('/users/1', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(avatar_digest('johnny@example.com'), response.get_json()['_links']['avatar'])
+        response = self.client.get('/users', headers=dict(self.headers, **{'If-None-Match': page_etag}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_listing_validators(self):
+        post = Post(author=self.user, price=3)
+        db.session.add(post)
+        db.session.commit()
+        response = self.client.get('/explore')
+        etag = response.headers['ETag']
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertEqual(self.client.get('/explore', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.client.get('/homefeed', headers={'If-None-Match': etag}).status_code, 200)
+        self.assertEqual(self.client.get('/explore?per_page=5', headers={'If-None-Match': etag}).status_code, 200)
+
+        post.price = 4
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore', headers={'If-None-Match': etag}).status_code, 200)
+        # an edit doesn't change the creation time of the post, a client that only has a date gets the new page
+        since = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        self.assertEqual(self.client.get('/explore', headers={'If-Modified-Since': since}).status_code, 200)
+        self.assertNotIn('ETag', self.client.get('/search?q=x').headers)
+
+
+class ResponseCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        listing_cache.clear()
+        listing_cache.routes.clear()
+        self.client = app.test_client()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cached_listing(self):
+        post = Post(post_title='Dune', author=self.user, price=3)
+        db.session.add(post)
+        db.session.commit()
+        first = self.client.get('/explore')
+        second = self.client.get('/explore')
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        response = self.client.get('/explore', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.client.get('/explore?per_page=5')
+        self.assertEqual(listing_cache.stats()['explore'], {'hits': 2, 'misses': 2, 'hit_ratio': 0.5})
+
+        # Any change to the posts is seen on the next request
+        post.price = 4
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore').get_json()['items'][0]['price'], 4)
+        db.session.add(Post(post_title='Emma', author=self.user, price=5))
+        db.session.rollback()
+        self.assertEqual(self.client.get('/explore').get_json()['_meta']['total_items'], 1)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore').get_json()['items'], [])
+        self.assertEqual(listing_cache.stats()['explore']['misses'], 4)
+
+    def test_import_clears_cache(self):
+        self.assertEqual(self.client.get('/homefeed').get_json()['items'], [])
+        import_posts([(1, {'post_title': 'Dune', 'price': '3'})], self.user)
+        self.assertEqual(len(self.client.get('/homefeed').get_json()['items']), 1)
+
+    # A page read before a concurrent commit cleared the cache is not stored
+    def test_stale_page_not_stored(self):
+        commits = [True]
+
+        def view():
+            # a post is committed by another request while this one builds its page
+            if commits.pop():
+                listing_cache.clear()
+            return 'page'
+
+        cached_view = listing_cache.cached(view)
+        with app.test_request_context('/homefeed'):
+            key = listing_cache.key()
+            cached_view()
+            self.assertIsNone(listing_cache.cache.get(key))
+            commits.append(False)
+            cached_view()
+            self.assertIsNotNone(listing_cache.cache.get(key))
+
+
+class PasswordHasherCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_process_pool(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', 1)
+        try:
+            password_hash = hasher.hash('cat')
+            self.assertIsNotNone(hasher.executor)
+        finally:
+            hasher.shutdown()
+        self.assertTrue(password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(PasswordHasher('pbkdf2:sha256:1000', 0).verify(password_hash, 'cat'))
+        self.assertFalse(hasher.needs_rehash(password_hash))
+
+    # A method without its cost parameters matches the hashes werkzeug makes with the default ones
+    def test_default_parameters(self):
+        hasher = PasswordHasher('pbkdf2:sha256', 0)
+        password_hash = hasher.hash('cat')
+        self.assertNotEqual(password_hash.split('$', 1)[0], 'pbkdf2:sha256')
+        self.assertFalse(PasswordHasher('pbkdf2:sha256', 0).needs_rehash(password_hash))
+        self.assertTrue(PasswordHasher('pbkdf2:sha256:1000', 0).needs_rehash(password_hash))
+        self.assertFalse(PasswordHasher('pbkdf2', 0).needs_rehash(password_hash))
+        for method in ('scrypt', 'pbkdf2:sha512'):
+            hasher = PasswordHasher(method, 0)
+            self.assertEqual(hasher.hash_prefix(), hasher.hash('cat').split('$', 1)[0])
+
+    def test_broken_pool(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', 1)
+        try:
+            hasher.hash('cat')
+            executor = hasher.executor
+            for process in list(executor._processes.values()):
+                process.kill()
+                process.join()
+            self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+            self.assertIsNot(hasher.executor, executor)
+        finally:
+            hasher.shutdown()
+
+    def test_rehash_on_login(self):
+        u = User(username='susan', email='susan@example.com')
+        with mock.patch.object(password_hasher, 'method', 'pbkdf2:sha256:1000'):
+            u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        old_hash = u.password_hash
+
+        headers = {'Authorization': 'Basic c3VzYW46ZG9n'}
+        self.assertEqual(self.client.post('/tokens', headers=headers).status_code, 401)
+        self.assertEqual(u.password_hash, old_hash)
+        headers = {'Authorization': 'Basic c3VzYW46Y2F0'}
+        self.assertEqual(self.client.post('/tokens', headers=headers).status_code, 200)
+        db.session.expire_all()
+        self.assertTrue(u.password_hash.startswith(password_hasher.method + '$'))
+        self.assertTrue(u.check_password('cat'))
+
+
+class ReadRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        listing_cache.clear()
+        self.client = app.test_client()
+        # The read database is a separate in-memory database, with a post that the main database doesn't have
+        self.read_engine = sa.create_engine('sqlite://')
+        db.metadata.create_all(self.read_engine)
+        with self.read_engine.begin() as connection:
+            connection.execute(sa.insert(User.__table__).values(id=1, username='susan', email='susan@example.com'))
+            connection.execute(sa.insert(Post.__table__).values(
+                post_title='Emma', price=5, user_id=1, timestamp=datetime.utcnow()))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.read_engine.dispose()
+        self.app_context.pop()
+
+    def test_get_bind(self):
+        with mock.patch.dict(db.engines, {'read': self.read_engine}):
+            with app.test_request_context('/explore'):
+                self.assertIs(db.session.get_bind(Post), self.read_engine)
+            with app.test_request_context('/explore', method='POST'):
+                self.assertIs(db.session.get_bind(Post), db.engine)
+            with app.test_request_context('/messages'):
+                self.assertIs(db.session.get_bind(Post), db.engine)
+            self.assertIs(db.session.get_bind(Post), db.engine)
+        with app.test_request_context('/explore'):
+            self.assertIs(db.session.get_bind(Post), db.engine)
+
+    def test_read_only_views(self):
+        with mock.patch.dict(db.engines, {'read': self.read_engine}):
+            data = self.client.get('/explore').get_json()
+            self.assertEqual([item['post_title'] for item in data['items']], ['Emma'])
+            # Writes go to the main database
+            u = User(username='john', email='john@example.com')
+            db.session.add(u)
+            db.session.commit()
+        with self.read_engine.connect() as connection:
+            self.assertEqual(connection.scalar(sa.select(sa.func.count()).select_from(User.__table__)), 1)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_sqlite_pragmas(self):
+        with db.engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA cache_size').scalar(), app.config['SQLITE_CACHE_SIZE'])
+
+
+class SQLInstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        for i in range(3):
+            db.session.add(User(username='user{}'.format(i), email='user{}@example.com'.format(i)))
+        db.session.commit()
+        sql_instrumentation.enable(db.engines.values())
+
+    def tearDown(self):
+        sql_instrumentation.disable()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_server_timing(self):
+        response = self.client.get('/search?q=dune')
+        self.assertRegex(response.headers['Server-Timing'], r'^db;dur=[0-9.]+;desc="[1-9][0-9]* queries"$')
+        sql_instrumentation.disable()
+        self.assertNotIn('Server-Timing', self.client.get('/search?q=dune').headers)
+
+    def test_repeated_statements(self):
+        with mock.patch.object(sql_instrumentation, 'threshold', 2):
+            with app.test_request_context('/search'):
+                app.preprocess_request()
+                db.session.expire_all()
+                for id in range(1, 4):
+                    db.session.execute(sa.select(User).where(User.id == id)).scalar_one()
+                with self.assertLogs(app.logger, 'WARNING') as logs:
+                    response = app.process_response(app.response_class())
+        self.assertIn('desc="3 queries"', response.headers['Server-Timing'])
+        self.assertIn('executed 3 times', logs.output[0])
+
+    def test_hook_order(self):
+        # the user loaded by the other before_request functions is counted
+        self.assertIs(app.before_request_funcs[None][0], start_query_stats)
+
+    def test_failed_statement(self):
+        with db.engine.connect() as connection:
+            with self.assertRaises(sa.exc.OperationalError):
+                connection.exec_driver_sql('SELECT * FROM missing_table')
+            self.assertEqual(connection.info['query_start_time'], [])
+
+
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = mock.patch.dict(app.config, {
+            'PROFILE_SAMPLE_RATE': 1.0, 'PROFILE_DIR': self.directory.name, 'PROFILE_MAX_FILES': 2})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        self.directory.cleanup()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_sampled_profiles(self):
+        for i in range(3):
+            self.assertEqual(self.client.get('/search?q=dune').status_code, 200)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory.name, 'search'))), 2)
+
+        result = app.test_cli_runner().invoke(args=['profile-report', '--top', '5', '--sort', 'tottime'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('search (2 profiles)', result.output)
+        self.assertEqual(len(result.output.splitlines()), 8)
+
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+        self.client.get('/search?q=dune')
+        self.assertEqual(len(os.listdir(os.path.join(self.directory.name, 'search'))), 2)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def sample(self, text, name):
+        for line in text.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[-1])
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ('endpoint',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'a"b')
+        text = render(merge([[histogram.collect()]]))
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertEqual(self.sample(text, 'latency_seconds_bucket{endpoint="a\\"b",le="0.1"}'), 2)
+        self.assertEqual(self.sample(text, 'latency_seconds_bucket{endpoint="a\\"b",le="1.0"}'), 3)
+        self.assertEqual(self.sample(text, 'latency_seconds_bucket{endpoint="a\\"b",le="+Inf"}'), 4)
+        self.assertEqual(self.sample(text, 'latency_seconds_count{endpoint="a\\"b"}'), 4)
+
+    def test_metrics_endpoint(self):
+        name = 'http_requests_total{endpoint="search",method="GET",status="200"}'
+        before = self.sample(self.client.get('/metrics').get_data(as_text=True), name) or 0
+        self.client.get('/search?q=dune')
+        self.client.get('/search?q=dune')
+        response = self.client.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertEqual(self.sample(text, name), before + 2)
+        self.assertIn('http_request_duration_seconds_count{endpoint="search"}', text)
+        self.assertGreater(self.sample(text, 'db_query_duration_seconds_count'), 0)
+        self.assertEqual(self.sample(text, 'mail_queue_depth'), 0)
+
+    # The parent process (the test runner) stands in for another worker
+    @unittest.skipIf(os.name != 'posix', 'POSIX only')
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # The snapshot of another worker process
+            other = [{'name': 'http_requests_total', 'type': 'counter', 'help': 'Requests.', 'samples': [
+                ['http_requests_total', {'endpoint': 'search', 'method': 'GET', 'status': '200'}, 5]]}]
+            with open(os.path.join(directory, '{}.json'.format(os.getppid())), 'w') as f:
+                json.dump(other, f)
+            name = 'http_requests_total{endpoint="search",method="GET",status="200"}'
+            with mock.patch.dict(app.config, {'METRICS_MULTIPROCESS_DIR': None}):
+                own = self.sample(self.client.get('/metrics').get_data(as_text=True), name) or 0
+            with mock.patch.dict(app.config, {'METRICS_MULTIPROCESS_DIR': directory}):
+                text = self.client.get('/metrics').get_data(as_text=True)
+                self.assertIn('{}.json'.format(os.getpid()), os.listdir(directory))
+            self.assertEqual(self.sample(text, name), own + 5)
+
+    # The counters of a dead process are archived and its gauges dropped
+    @unittest.skipIf(os.name != 'posix', 'POSIX only')
+    def test_dead_process(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            dead = [{'name': 'http_requests_total', 'type': 'counter', 'help': 'Requests.', 'samples': [
+                ['http_requests_total', {'endpoint': 'search', 'method': 'GET', 'status': '200'}, 5]]},
+                {'name': 'mail_queue_depth', 'type': 'gauge', 'help': 'Emails.', 'samples': [['mail_queue_depth', {}, 7]]}]
+            for pid in (process.pid, os.getpid()):
+                with open(os.path.join(directory, '{}.json'.format(pid)), 'w') as f:
+                    json.dump(dead, f)
+            name = 'http_requests_total{endpoint="search",method="GET",status="200"}'
+            with mock.patch.dict(app.config, {'METRICS_MULTIPROCESS_DIR': None}):
+                own = self.sample(self.client.get('/metrics').get_data(as_text=True), name) or 0
+            # The snapshot left with the pid of this process is archived instead of overwritten
+            writer = SnapshotWriter(registry)
+            with mock.patch.dict(app.config, {'METRICS_MULTIPROCESS_DIR': directory}), \
+                    mock.patch('api.metrics.snapshot_writer', writer):
+                text = self.client.get('/metrics').get_data(as_text=True)
+            self.assertNotIn('{}.json'.format(process.pid), os.listdir(directory))
+            self.assertIn('archive.json', os.listdir(directory))
+            self.assertEqual(self.sample(text, name), own + 10)
+            self.assertEqual(self.sample(text, 'mail_queue_depth'), 0)
+
+
+class ConversationCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = app.test_client()
+        self.john, self.susan, self.mary = [User(username=name, email=name + '@example.com')
+                                            for name in ('john', 'susan', 'mary')]
+        db.session.add_all([self.john, self.susan, self.mary])
+        now = datetime.utcnow()
+        self.john.last_message_read_time = now - timedelta(seconds=25)
+        for i, (sender, recipient) in enumerate([
+                (self.susan, self.john), (self.john, self.susan), (self.mary, self.john),
+                (self.susan, self.john), (self.susan, self.john)]):
+            db.session.add(Message(author=sender, recipient=recipient, body='message {}'.format(i),
+                                   timestamp=now - timedelta(seconds=50 - i * 10)))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.john.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_conversations(self):
+        rows = db.session.execute(self.john.conversations()).all()
+        self.assertEqual([(user.username, message.body, count, unread) for user, message, count, unread in rows],
+                         [('susan', 'message 4', 4, 2), ('mary', 'message 2', 1, 0)])
+
+        data = self.client.get('/conversations?per_page=1').get_json()
+        self.assertEqual(data['items'][0]['user']['username'], 'susan')
+        self.assertEqual(data['items'][0]['unread_count'], 2)
+        data = self.client.get(data['_links']['next']).get_json()
+        self.assertEqual(data['items'][0]['last_message']['body'], 'message 2')
+        self.assertIsNone(data['_links']['next'])
+
+    def test_conversation_pages(self):
+        data = self.client.get('/conversations/{}?per_page=3'.format(self.susan.id)).get_json()
+        self.assertEqual([m['body'] for m in data['items']], ['message 4', 'message 3', 'message 1'])
+        data = self.client.get(data['_links']['next']).get_json()
+        self.assertEqual([m['body'] for m in data['items']], ['message 0'])
+        self.assertIsNone(data['_links']['next'])
+        self.assertEqual(self.client.get('/conversations/99').status_code, 404)
+
+
+class SerializerCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_links(self):
+        with app.test_request_context():
+            for endpoint in ('get_user', 'get_followers', 'get_followed', 'conversation'):
+                self.assertEqual(link(endpoint, 42), url_for(endpoint, id=42))
+        with app.test_request_context(base_url='http://localhost/shop'):
+            self.assertEqual(link('get_user', 42), '/shop/users/42')
+
+    def test_avatar_digest(self):
+        u = User(username='john', email='John@Example.com')
+        hits = avatar_digest.cache_info().hits
+        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
+                                         'd4c74594d841139328695756648b6bd6'
+                                         '?d=identicon&s=128'))
+        u.avatar(36)
+        self.assertEqual(avatar_digest.cache_info().hits, hits + 1)
+
+    @unittest.skipUnless(orjson, 'orjson is not installed')
+    def test_orjson_provider(self):
+        u = User(username='john', email='john@example.com', last_seen=datetime(2023, 1, 2, 3, 4, 5))
+        db.session.add(u)
+        db.session.commit()
+        with app.test_request_context():
+            data = {'user': u.to_dict(), 'when': datetime(2023, 1, 2), 'price': None}
+            self.assertEqual(json.loads(OrjsonProvider(app).dumps(data)), json.loads(app.json.dumps(data)))
+
+    @unittest.skipUnless(orjson, 'orjson is not installed')
+    def test_orjson_fallback(self):
+        provider = OrjsonProvider(app)
+        self.assertEqual(provider.dumps({'price': 2 ** 70}), '{"price": 1180591620717411303424}')
+        self.assertEqual(provider.loads('{"price": 1.5}', parse_float=Decimal), {'price': Decimal('1.5')})
+
+
+@unittest.skipUnless(AsyncApplication, 'aiosqlite and asgiref are not installed')
+class AsgiCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        token_cache.clear()
+        listing_cache.clear()
+        # The async views read a database file, written here with a regular engine
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'asgi.db')
+        engine = sa.create_engine('sqlite:///' + path)
+        db.metadata.create_all(engine)
+        now = datetime.utcnow()
+        with engine.begin() as connection:
+            connection.execute(sa.insert(User.__table__), [
+                {'username': 'john', 'email': 'john@example.com', 'last_seen': now,
+                 'token': 'john-token', 'token_expiration': now + timedelta(hours=1)},
+                {'username': 'susan', 'email': 'susan@example.com', 'last_seen': now,
+                 'token': None, 'token_expiration': None}])
+            connection.execute(sa.insert(Post.__table__), [
+                {'post_title': 'Book {}'.format(i), 'price': i, 'user_id': 1, 'timestamp': now + timedelta(seconds=i)}
+                for i in range(3)])
+            connection.execute(sa.text("INSERT INTO notification (name, user_id, timestamp, payload_json) "
+                                       "VALUES ('unread_message_count', 1, 10, '2')"))
+        engine.dispose()
+        self.application = AsyncApplication(app, create_async_engine('sqlite+aiosqlite:///' + path))
+
+    def tearDown(self):
+        asyncio.run(self.application.engine.dispose())
+        self.directory.cleanup()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def scope(self, path, query_string=b'', headers=()):
+        return {'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': query_string,
+                'http_version': '1.1', 'headers': [(name.lower().encode(), value.encode()) for name, value in headers]}
+
+    async def request(self, path, query_string=b'', headers=()):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.application(self.scope(path, query_string, headers), receive, send)
+        return messages[0]['status'], dict(messages[0]['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+    def get(self, path, query_string=b'', headers=()):
+        return asyncio.run(self.request(path, query_string, headers))
+
+    def session_cookie(self, user_id='1'):
+        with app.test_client() as client:
+            with client.session_transaction() as s:
+                s['_user_id'] = user_id
+            return 'session=' + client.get_cookie('session').value
+
+    def test_users(self):
+        status, headers, body = self.get('/users', b'per_page=1', [('Authorization', 'Bearer john-token')])
+        self.assertEqual(status, 200)
+        data = json.loads(body)
+        self.assertEqual([u['username'] for u in data['items']], ['john'])
+        self.assertEqual(data['_meta']['total_items'], 2)
+        self.assertEqual(data['_links']['next'], '/users?page=2&per_page=1')
+        status, headers, body = self.get('/users', b'per_page=1', [
+            ('Authorization', 'Bearer john-token'), ('If-None-Match', headers[b'etag'].decode())])
+        self.assertEqual(status, 304)
+        # Requests without a valid token are answered by the Flask view
+        self.assertEqual(self.get('/users', headers=[('Authorization', 'Bearer wrong')])[0], 401)
+
+    def test_explore(self):
+        status, headers, body = self.get('/explore', b'per_page=2')
+        self.assertEqual([p['post_title'] for p in json.loads(body)['items']], ['Book 2', 'Book 1'])
+        self.assertEqual(json.loads(self.get('/explore', b'per_page=2')[2]), json.loads(body))
+        self.assertEqual(listing_cache.stats()['explore']['hits'], 1)
+
+    # The async views run the request hooks, and their statements are counted on the async engine
+    def test_request_hooks(self):
+        teardown = mock.Mock()
+        queries = registry.collect()
+        with mock.patch.dict(app.config, {'SQL_INSTRUMENTATION': True}):
+            self.application = AsyncApplication(app, self.application.engine)
+        try:
+            with mock.patch.dict(app.teardown_request_funcs, {None: [teardown]}):
+                status, headers, body = self.get('/explore')
+        finally:
+            sql_instrumentation.disable()
+        self.assertEqual(status, 200)
+        self.assertIn('desc="2 queries"', headers[b'server-timing'].decode())
+        teardown.assert_called_once_with(None)
+        self.assertGreater(self.query_count(registry.collect()), self.query_count(queries))
+
+    def query_count(self, snapshot):
+        return merge([snapshot])['db_query_duration_seconds']['samples'][('db_query_duration_seconds_count', ())]
+
+    def test_notifications(self):
+        status, headers, body = self.get('/notifications', headers=[('Cookie', self.session_cookie())])
+        self.assertEqual(json.loads(body), [{'name': 'unread_message_count', 'data': 2, 'timestamp': 10}])
+        self.assertEqual(self.get('/notifications')[0], 302)
+        # The session of a deleted user goes to Flask-Login, which doesn't find the user either
+        self.assertEqual(self.get('/notifications', headers=[('Cookie', self.session_cookie('3'))])[0], 302)
+
+    # An open notification stream holds no thread, and the requests that go to the Flask application
+    # still get their response while another Flask view is busy
+    def test_stream_and_fallback(self):
+        busy = threading.Event()
+
+        def homefeed():
+            busy.wait(5)
+            return {'items': []}
+
+        async def run():
+            messages = asyncio.Queue()
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            stream = asyncio.ensure_future(self.application(
+                self.scope('/notifications/stream', headers=[('Cookie', self.session_cookie())]), receive, messages.put))
+            self.assertEqual((await asyncio.wait_for(messages.get(), 5))['status'], 200)
+            self.assertIn(b'event: unread_message_count', (await asyncio.wait_for(messages.get(), 5))['body'])
+
+            feed = asyncio.ensure_future(self.request('/homefeed'))
+            status = (await asyncio.wait_for(self.request('/users/1'), 5))[0]
+            self.assertEqual(status, 401)
+            self.assertFalse(feed.done())
+            busy.set()
+            self.assertEqual((await asyncio.wait_for(feed, 5))[0], 200)
+
+            # Notifications are published from the thread that committed them
+            publisher = threading.Thread(target=notification_hub.publish, args=(
+                1, {'name': 'unread_message_count', 'data': 3, 'timestamp': 11}))
+            publisher.start()
+            publisher.join()
+            self.assertIn(b'data: 3', (await asyncio.wait_for(messages.get(), 5))['body'])
+
+            disconnected.set()
+            await asyncio.wait_for(stream, 5)
+
+        with mock.patch.dict(app.view_functions, {'homefeed': homefeed}):
+            asyncio.run(run())
+        self.assertNotIn(1, notification_hub.subscribers)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file